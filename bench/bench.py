@@ -0,0 +1,119 @@
+#!/usr/bin/python3
+"""
+End-to-end benchmark of twvdscli against local mock API (bench/mock_api.py).
+
+For every fleet size a fresh mock is started in this process, and commands
+are run as separate processes, like users and cron jobs run them.
+Wall time and number of API calls (by endpoint) are reported per command:
+
+    python3 bench/bench.py --fleets 1 100 1000 --latency 0.02 --transition 0.5
+"""
+
+import argparse
+import base64
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import urllib.request
+from time import perf_counter
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from mock_api import Mock, State  # noqa: E402
+
+CLI = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'twvdscli.py')
+
+# {first} is id of first VDS, {ids} are ids of all of them
+COMMANDS = [
+    'balance',
+    'vds list',
+    '-o ndjson vds list',
+    'vds info plans',
+    'vds info os',
+    'dbs list',
+    'vds snap create {first}',
+    'vds snap get {first}',
+    'vds backup create {first}',
+    'vds backup list {first}',
+    'vds stop {ids} --concurrency {concurrency}',
+    'vds start {ids} --concurrency {concurrency}',
+    'vds clone {first}',
+    'vds clone {first} --count 10 --concurrency 10',
+]
+
+
+def mock_call(mock, path):
+    request = urllib.request.Request(mock.url + path, method='POST' if path.endswith('reset') else 'GET')
+    with urllib.request.urlopen(request) as response:
+        return json.loads(response.read())
+
+
+def run(mock, env, command, options=()):
+    mock_call(mock, '/_mock/reset')
+    start = perf_counter()
+    result = subprocess.run([sys.executable, CLI] + list(options) + command.split(), env=env, stdin=subprocess.DEVNULL,
+                            stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+    elapsed = perf_counter() - start
+    stats = mock_call(mock, '/_mock/stats')
+    return dict(command=command, seconds=round(elapsed, 3), exit_code=result.returncode,
+                calls=stats['total'], endpoints=stats['calls'],
+                stderr=result.stderr.strip().splitlines()[-1:] if result.returncode else [])
+
+
+def bench_fleet(fleet, args):
+    state = State(fleet=fleet, transition=args.transition)
+    mock = Mock(('127.0.0.1', 0), state, latency=args.latency, error_rate=args.error_rate,
+                rate_limit=args.rate_limit).start()
+    ids = sorted(state.servers)
+    with tempfile.TemporaryDirectory() as home:
+        os.makedirs(os.path.join(home, '.config'))
+        with open(os.path.join(home, '.config', 'twvdscli.ini'), 'w') as config:
+            config.write('[api]\nkey = {}\n'.format(base64.b64encode(b'bench:bench').decode()))
+        env = dict(os.environ, HOME=home, TWVDSCLI_API_URL=mock.url)
+        # Log in once, so that token is cached like on a real workstation
+        run(mock, env, 'balance')
+        options = ['--rate-limit', str(args.client_rate)]
+        for template in COMMANDS:
+            command = template.format(first=ids[0], ids=' '.join(map(str, ids)), concurrency=args.concurrency)
+            result = run(mock, env, command, options)
+            result['fleet'] = fleet
+            if len(result['command']) > 60:
+                result['command'] = template.format(first=ids[0], ids='<{} ids>'.format(len(ids)),
+                                                    concurrency=args.concurrency)
+            yield result
+    mock.shutdown()
+    mock.server_close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--fleets', type=int, nargs='+', default=[1, 100, 1000])
+    parser.add_argument('--latency', type=float, default=0.02, help='mean API latency, seconds')
+    parser.add_argument('--transition', type=float, default=0.5, help='status change delay, seconds')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='share of 503 responses')
+    parser.add_argument('--rate-limit', type=float, default=0.0, help='share of 429 responses')
+    parser.add_argument('--client-rate', type=float, default=0,
+                        help='client side --rate-limit, requests per second, 0 is no limit')
+    parser.add_argument('--concurrency', type=int, default=32, help='--concurrency for bulk commands')
+    parser.add_argument('--json', action='store_true', help='print results as ndjson')
+    args = parser.parse_args()
+
+    if not args.json:
+        print('{:>6}  {:<50} {:>9} {:>7} {:>5}'.format('fleet', 'command', 'seconds', 'calls', 'exit'))
+    failed = False
+    for fleet in args.fleets:
+        for result in bench_fleet(fleet, args):
+            failed = failed or result['exit_code'] != 0
+            if args.json:
+                print(json.dumps(result), flush=True)
+            else:
+                print('{fleet:>6}  {command:<50} {seconds:>9.3f} {calls:>7} {exit_code:>5}'.format(**result),
+                      flush=True)
+                for line in result['stderr']:
+                    print('        ' + line)
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,401 @@
+#!/usr/bin/python3
+"""
+Local stand-in for Timeweb public API, for benchmarks and testing without billable servers.
+
+Implements endpoints used by twvdscli, with configurable latency, delay of
+status transitions (start/stop/create/clone/remove take time) and injection
+of 5xx errors and 429 responses. Point twvdscli to it with TWVDSCLI_API_URL:
+
+    python3 bench/mock_api.py --port 8080 --fleet 100 --latency 0.05 --transition 2
+    TWVDSCLI_API_URL=http://127.0.0.1:8080 ./twvdscli.py vds list
+
+Any login/password is accepted. Counters of calls per endpoint are served
+on GET /_mock/stats, POST /_mock/reset clears them.
+"""
+
+import argparse
+import json
+import random
+import re
+import threading
+from collections import Counter
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from time import sleep, time
+from urllib.parse import parse_qs, urlparse
+
+TOKEN = 'mock-token'
+
+PRESETS = [
+    dict(id=17, cpu=1, ram=1024, drive=15, discount_value=199, name='Cloud 15', description='1 CPU, 1 GB'),
+    dict(id=18, cpu=1, ram=2048, drive=30, discount_value=339, name='Cloud 30', description='1 CPU, 2 GB'),
+    dict(id=20, cpu=2, ram=4096, drive=60, discount_value=659, name='Cloud 60', description='2 CPU, 4 GB'),
+    dict(id=22, cpu=4, ram=8192, drive=120, discount_value=1299, name='Cloud 120', description='4 CPU, 8 GB'),
+]
+OSES = [
+    dict(id=47, os_caption='Ubuntu 18.04', os_type='linux', os_name='ubuntu', os_latin='ubuntu-18.04', is_public=True),
+    dict(id=79, os_caption='Ubuntu 20.04', os_type='linux', os_name='ubuntu', os_latin='ubuntu-20.04', is_public=True),
+    dict(id=63, os_caption='Debian 11', os_type='linux', os_name='debian', os_latin='debian-11', is_public=True),
+]
+
+# (method, regex, endpoint template, handler name)
+ROUTES = [
+    ('POST', r'/api/v2/auth', '/api/v2/auth', 'auth'),
+    ('GET', r'/api/v2/vds', '/api/v2/vds', 'vds_list'),
+    ('GET', r'/api/v2/vds/(\d+)', '/api/v2/vds/{id}', 'vds_get'),
+    ('POST', r'/api/v1/vds', '/api/v1/vds', 'vds_create'),
+    ('DELETE', r'/api/v1/vds/(\d+)', '/api/v1/vds/{id}', 'vds_remove'),
+    ('PUT', r'/api/v1/vds/(\d+)', '/api/v1/vds/{id}', 'vds_update'),
+    ('POST', r'/api/v1/vds/(\d+)/(start|shutdown|clone)', '/api/v1/vds/{id}/{action}', 'vds_action'),
+    ('GET', r'/api/v1/restore-points/(\d+)', '/api/v1/restore-points/{id}', 'snap_get'),
+    ('POST', r'/api/v1/restore-points/(\d+)/(create|commit|rollback)', '/api/v1/restore-points/{id}/{action}',
+     'snap_action'),
+    ('GET', r'/api/v1/backups/vds/(\d+)/drive/(\d+)', '/api/v1/backups/vds/{id}/drive/{disk_id}', 'backup_list'),
+    ('POST', r'/api/v1/backups/vds/(\d+)/drive/(\d+)', '/api/v1/backups/vds/{id}/drive/{disk_id}', 'backup_create'),
+    ('DELETE', r'/api/v1/backups/(\d+)/vds/(\d+)/drive/(\d+)',
+     '/api/v1/backups/{backup_id}/vds/{id}/drive/{disk_id}', 'backup_remove'),
+    ('GET', r'/api/v1/dbs', '/api/v1/dbs', 'dbs_list'),
+    ('POST', r'/api/v1/dbs', '/api/v1/dbs', 'dbs_create'),
+    ('GET', r'/api/v1/dbs/(\d+)', '/api/v1/dbs/{db_id}', 'dbs_get'),
+    ('GET', r'/api/v1/presets', '/api/v1/presets', 'presets'),
+    ('GET', r'/api/v1/os', '/api/v1/os', 'oses'),
+    ('GET', r'/api/v1/accounts/finances', '/api/v1/accounts/finances', 'finances'),
+    ('GET', r'/api/v1/accounts/([^/]+)/group', '/api/v1/accounts/{user}/group', 'group'),
+]
+
+
+class State:
+    """
+    Servers, DBs, backups and restore points of mock account.
+    Status changes are scheduled: (status, at) is applied when someone looks at the server after `at`.
+    """
+    def __init__(self, fleet=10, dbs=2, transition=1.0):
+        self.lock = threading.Lock()
+        self.transition = transition
+        self.servers = dict()
+        self.dbs = dict()
+        self.backups = dict()
+        self.snapshots = dict()
+        self.next_id = 1
+        for n in range(fleet):
+            self.add_server('web-{}'.format(n + 1), PRESETS[n % len(PRESETS)]['id'], 'on')
+        for n in range(dbs):
+            self.add_db('db-{}'.format(n + 1), 'mysql' if n % 2 == 0 else 'postgres', 'started')
+
+    def new_id(self):
+        self.next_id += 1
+        return self.next_id - 1
+
+    def add_server(self, name, preset_id, status, os_id=47, comment=''):
+        preset = [i for i in PRESETS if i['id'] == preset_id][0]
+        vds_id = self.new_id()
+        self.servers[vds_id] = dict(
+            id=vds_id,
+            name=name,
+            status=status,
+            ip='10.{}.{}.{}'.format(vds_id // 65536 % 256, vds_id // 256 % 256, vds_id % 256),
+            preset_id=preset_id,
+            comment=comment,
+            configuration=dict(caption=name, cpu=preset['cpu'], ram=preset['ram'],
+                               disk_size=preset['drive'], os=os_id),
+            disk_stats=dict(disk_id=vds_id + 100000),
+            _pending=None
+        )
+        return self.servers[vds_id]
+
+    def add_db(self, name, db_type, status, password='secret'):
+        db_id = self.new_id()
+        self.dbs[db_id] = dict(id=db_id, name=name, status=status, type=db_type, login='user',
+                               password=password, ip='10.200.0.{}'.format(db_id % 256),
+                               local_ip='192.168.0.{}'.format(db_id % 256), _pending=None)
+        return self.dbs[db_id]
+
+    def schedule(self, item, status, then):
+        """
+        Item gets status now, and then after transition delay
+        """
+        item['status'] = status
+        item['_pending'] = (then, time() + self.transition)
+
+    def settle(self, item):
+        if item and item['_pending'] and item['_pending'][1] <= time():
+            item['status'] = item['_pending'][0]
+            item['_pending'] = None
+        return item
+
+    def settle_all(self):
+        for vds_id, server in list(self.servers.items()):
+            self.settle(server)
+            if server['status'] == 'deleted':
+                del self.servers[vds_id]
+        for db in self.dbs.values():
+            self.settle(db)
+
+    def server(self, vds_id):
+        server = self.settle(self.servers.get(vds_id))
+        if server and server['status'] == 'deleted':
+            del self.servers[vds_id]
+            return None
+        return server
+
+
+def public(item):
+    return dict((k, v) for k, v in item.items() if not k.startswith('_'))
+
+
+class Mock(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, state, latency=0.0, error_rate=0.0, rate_limit=0.0, retry_after=1):
+        super().__init__(address, Handler)
+        self.state = state
+        self.latency = latency
+        self.error_rate = error_rate
+        self.rate_limit = rate_limit
+        self.retry_after = retry_after
+        self.calls = Counter()
+        self.calls_lock = threading.Lock()
+
+    @property
+    def url(self):
+        return 'http://{}:{}'.format(*self.server_address[:2])
+
+    def start(self):
+        """
+        Serve in background thread, for use from benchmarks
+        """
+        thread = threading.Thread(target=self.serve_forever, daemon=True)
+        thread.start()
+        return self
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        self.dispatch('GET')
+
+    def do_POST(self):
+        self.dispatch('POST')
+
+    def do_DELETE(self):
+        self.dispatch('DELETE')
+
+    def do_PUT(self):
+        self.dispatch('PUT')
+
+    def send(self, code, body=None, headers=None):
+        data = b'' if body is None else json.dumps(body).encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def dispatch(self, method):
+        url = urlparse(self.path)
+        length = int(self.headers.get('Content-Length') or 0)
+        self.body = json.loads(self.rfile.read(length) or b'null') if length else None
+        self.query = parse_qs(url.query)
+        mock = self.server
+
+        if url.path == '/_mock/stats':
+            with mock.calls_lock:
+                return self.send(200, dict(calls=dict(mock.calls), total=sum(mock.calls.values())))
+        if url.path == '/_mock/reset':
+            with mock.calls_lock:
+                mock.calls.clear()
+            return self.send(200, {})
+
+        for route_method, pattern, template, handler in ROUTES:
+            match = re.fullmatch(pattern, url.path)
+            if route_method == method and match:
+                break
+        else:
+            return self.send(404, dict(error='not found'))
+
+        with mock.calls_lock:
+            mock.calls[method + ' ' + template] += 1
+        if mock.latency:
+            sleep(mock.latency * random.uniform(0.5, 1.5))
+        if mock.rate_limit and random.random() < mock.rate_limit:
+            return self.send(429, dict(error='rate limited'), {'Retry-After': str(mock.retry_after)})
+        if mock.error_rate and random.random() < mock.error_rate:
+            return self.send(503, dict(error='injected error'))
+        if handler != 'auth' and self.headers.get('Authorization') != 'Bearer ' + TOKEN:
+            return self.send(401, dict(error='unauthorized'))
+        with mock.state.lock:
+            code, body, headers = getattr(self, handler)(mock.state, *match.groups())
+        self.send(code, body, headers)
+
+    # Handlers return (code, body, headers)
+
+    def auth(self, state):
+        if not (self.headers.get('Authorization') or '').startswith('Basic '):
+            return 401, dict(error='unauthorized'), None
+        return 200, dict(access_token=TOKEN, expires_in=3600, token_type='Bearer'), None
+
+    def vds_list(self, state):
+        state.settle_all()
+        servers = [public(i) for i in state.servers.values()]
+        offset = int(self.query.get('offset', [0])[0])
+        limit = int(self.query.get('limit', [len(servers)])[0])
+        return 200, dict(servers=servers[offset:offset + limit], meta=dict(total=len(servers))), None
+
+    def vds_get(self, state, vds_id):
+        server = state.server(int(vds_id))
+        if server is None:
+            return 404, dict(error='not found'), None
+        return 200, dict(server=public(server)), None
+
+    def vds_create(self, state):
+        data = self.body['server']
+        server = state.add_server(data['configuration']['caption'], data['preset_id'], 'installing',
+                                  os_id=data['configuration']['os'], comment=data.get('comment', ''))
+        state.schedule(server, 'installing', 'on')
+        return 200, dict(server=public(server)), None
+
+    def vds_remove(self, state, vds_id):
+        server = state.server(int(vds_id))
+        if server is None:
+            return 404, dict(error='not found'), None
+        state.schedule(server, 'removing', 'deleted')
+        return 200, dict(server=public(server)), None
+
+    def vds_update(self, state, vds_id):
+        server = state.server(int(vds_id))
+        if server is None:
+            return 404, dict(error='not found'), None
+        data = self.body['server']
+        if 'name' in data:
+            server['name'] = server['configuration']['caption'] = data['name']
+        if 'comment' in data:
+            server['comment'] = data['comment']
+        return 200, dict(server=public(server)), None
+
+    def vds_action(self, state, vds_id, action):
+        server = state.server(int(vds_id))
+        if server is None:
+            return 404, dict(error='not found'), None
+        if action == 'start':
+            state.schedule(server, 'starting', 'on')
+        elif action == 'shutdown':
+            state.schedule(server, 'stopping', 'off')
+        else:
+            clone = state.add_server(server['name'] + '-clone', server['preset_id'], 'installing',
+                                     os_id=server['configuration']['os'], comment=server['comment'])
+            state.schedule(clone, 'installing', 'on')
+            return 200, dict(server=public(clone)), None
+        return 200, dict(server=public(server)), None
+
+    def snap_get(self, state, vds_id):
+        point = state.snapshots.get(int(vds_id))
+        if point is None:
+            return 404, dict(error='no restore point'), None
+        return 200, dict(restore_point=point), None
+
+    def snap_action(self, state, vds_id, action):
+        vds_id = int(vds_id)
+        if state.server(vds_id) is None:
+            return 404, dict(error='not found'), None
+        if action == 'create':
+            now = datetime.utcnow()
+            state.snapshots[vds_id] = dict(id=state.new_id(), created_at=now.isoformat(timespec='seconds'),
+                                           expired_at=(now + timedelta(days=3)).isoformat(timespec='seconds'))
+        elif vds_id not in state.snapshots:
+            return 404, dict(error='no restore point'), None
+        else:
+            del state.snapshots[vds_id]
+        return 200, dict(result='ok'), None
+
+    def backup_list(self, state, vds_id, disk_id):
+        if state.server(int(vds_id)) is None:
+            return 404, dict(error='not found'), None
+        return 200, dict(backups=state.backups.get(int(vds_id), [])), None
+
+    def backup_create(self, state, vds_id, disk_id):
+        server = state.server(int(vds_id))
+        if server is None or server['disk_stats']['disk_id'] != int(disk_id):
+            return 404, dict(error='not found'), None
+        backup = dict(id=state.new_id(), c_date=datetime.utcnow().isoformat(timespec='seconds'),
+                      drive_size=server['configuration']['disk_size'], cost_backup=0, mounted=False,
+                      status='done')
+        state.backups.setdefault(int(vds_id), []).append(backup)
+        return 200, dict(backup=backup), None
+
+    def backup_remove(self, state, backup_id, vds_id, disk_id):
+        backups = state.backups.get(int(vds_id), [])
+        left = [i for i in backups if i['id'] != int(backup_id)]
+        if len(left) == len(backups):
+            return 404, dict(error='not found'), None
+        state.backups[int(vds_id)] = left
+        return 200, dict(result='ok'), None
+
+    def dbs_list(self, state):
+        state.settle_all()
+        dbs = [public(i) for i in state.dbs.values()]
+        offset = int(self.query.get('offset', [0])[0])
+        limit = int(self.query.get('limit', [len(dbs)])[0])
+        return 200, dict(dbs=dbs[offset:offset + limit], meta=dict(total=len(dbs))), None
+
+    def dbs_create(self, state):
+        db = state.add_db(self.body['name'], self.body['type'], 'installing', password=self.body['password'])
+        state.schedule(db, 'installing', 'started')
+        return 200, dict(db=public(db)), None
+
+    def dbs_get(self, state, db_id):
+        db = state.settle(state.dbs.get(int(db_id)))
+        if db is None:
+            return 404, dict(error='not found'), None
+        return 200, dict(db=public(db)), None
+
+    def catalog(self, key, items):
+        etag = '"{}-{}"'.format(key, len(items))
+        if self.headers.get('If-None-Match') == etag:
+            return 304, None, {'ETag': etag}
+        return 200, {key: items, 'meta': dict(total=len(items))}, {'ETag': etag}
+
+    def presets(self, state):
+        return self.catalog('presets', PRESETS)
+
+    def oses(self, state):
+        return self.catalog('os', OSES)
+
+    def finances(self, state):
+        state.settle_all()
+        cost = sum(p['discount_value'] for i in state.servers.values() for p in PRESETS if p['id'] == i['preset_id'])
+        return 200, dict(finances=dict(balance=10000, monthly_cost=cost)), None
+
+    def group(self, state, user):
+        return 200, dict(groups=[dict(id=1, name='default')]), None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--fleet', type=int, default=10, help='number of VDS at start')
+    parser.add_argument('--dbs', type=int, default=2, help='number of DBs at start')
+    parser.add_argument('--latency', type=float, default=0.0, help='mean response latency, seconds')
+    parser.add_argument('--transition', type=float, default=1.0, help='status change delay, seconds')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='share of 503 responses')
+    parser.add_argument('--rate-limit', type=float, default=0.0, help='share of 429 responses')
+    parser.add_argument('--retry-after', type=int, default=1, help='Retry-After of 429, seconds')
+    args = parser.parse_args()
+
+    mock = Mock((args.host, args.port), State(args.fleet, args.dbs, args.transition), latency=args.latency,
+                error_rate=args.error_rate, rate_limit=args.rate_limit, retry_after=args.retry_after)
+    print('Mock Timeweb API on ' + mock.url, flush=True)
+    try:
+        mock.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
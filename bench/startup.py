@@ -0,0 +1,91 @@
+#!/usr/bin/python3
+"""
+Startup time benchmark for twvdscli.
+
+Runs `twvdscli.py --help` (and help of a few subcommands) in a clean HOME,
+so there is no config and no cached token, and checks that:
+* it does not prompt for credentials or go to network (stdin is closed);
+* heavy modules are not imported on this path (python -X importtime);
+* median wall time over python startup is below --max-ms.
+
+Exit code is 1 if any check fails, so it can guard against regressions:
+
+    python3 bench/startup.py --runs 20 --max-ms 150
+"""
+
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+from time import perf_counter
+
+CLI = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'twvdscli.py')
+# Modules that must be imported lazily, only when command talks to API or prints a table
+LAZY_MODULES = ('requests', 'urllib3', 'prettytable', 'asyncio', 'configparser', 'hashlib')
+COMMANDS = (['--help'], ['vds', '--help'], ['vds', 'start', '--help'], ['dbs', 'list', '--help'])
+
+
+def run(args, env, importtime=False):
+    cmd = [sys.executable]
+    if importtime:
+        cmd += ['-X', 'importtime']
+    cmd += args
+    start = perf_counter()
+    result = subprocess.run(cmd, env=env, stdin=subprocess.DEVNULL,
+                            stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+    return perf_counter() - start, result
+
+
+def imported(stderr):
+    """
+    Names of modules from -X importtime output
+    """
+    names = set()
+    for line in stderr.splitlines():
+        if line.startswith('import time:') and '|' in line:
+            names.add(line.rsplit('|', 1)[1].strip())
+    return names
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--runs', type=int, default=10, help='runs per command')
+    parser.add_argument('--max-ms', type=float, default=200,
+                        help='max median time over bare interpreter start, ms')
+    args = parser.parse_args()
+
+    failed = False
+    with tempfile.TemporaryDirectory() as home:
+        env = dict(os.environ, HOME=home)
+        baseline = statistics.median(run(['-c', 'pass'], env)[0] for _ in range(args.runs))
+        print('python startup: {:.1f} ms'.format(baseline * 1000))
+
+        for command in COMMANDS:
+            name = ' '.join(command)
+            _, result = run([CLI] + command, env, importtime=True)
+            if result.returncode != 0:
+                print('FAIL {}: exit code {}\n{}'.format(name, result.returncode, result.stderr[-2000:]))
+                failed = True
+                continue
+            heavy = sorted(m for m in imported(result.stderr) if m.split('.')[0] in LAZY_MODULES)
+            if heavy:
+                print('FAIL {}: imported {}'.format(name, ', '.join(heavy)))
+                failed = True
+            if os.listdir(home):
+                print('FAIL {}: wrote to HOME: {}'.format(name, os.listdir(home)))
+                failed = True
+
+            times = [run([CLI] + command, env)[0] for _ in range(args.runs)]
+            overhead = (statistics.median(times) - baseline) * 1000
+            status = 'ok' if overhead <= args.max_ms else 'FAIL'
+            failed = failed or status == 'FAIL'
+            print('{:4} {:24} median {:7.1f} ms over python, min {:7.1f} ms total'.format(
+                status, name, overhead, min(times) * 1000))
+
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
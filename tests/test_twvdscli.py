@@ -0,0 +1,264 @@
+"""
+Tests of pure parts of twvdscli: selectors, picker scoring, backup retention, retries, paging, task graph.
+They need no API: run with python -m pytest
+"""
+
+import os
+import sys
+from time import time
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import twvdscli  # noqa: E402
+
+SERVERS = [
+    dict(id=1, name='web-1', ip='10.0.0.1', status='on', cpus=1, ram=1024),
+    dict(id=2, name='web-2', ip='10.0.0.2', status='off', cpus=2, ram=4096),
+    dict(id=10, name='web-10', ip='10.0.1.10', status='on', cpus=4, ram=8192),
+    dict(id=20, name='db-main', ip=None, status='on', cpus=2, ram=2048),
+]
+
+
+def matching(selector, records=SERVERS):
+    check = twvdscli.parse_selector(selector)
+    return [i['id'] for i in records if check(i)]
+
+
+@pytest.fixture
+def index(monkeypatch, tmp_path):
+    """
+    Fresh local index of SERVERS, with HOME where there is no config and cache
+    """
+    monkeypatch.setenv('HOME', str(tmp_path))
+    twvdscli.load_config.cache_clear()
+    monkeypatch.setitem(twvdscli.indexes, 'vds', dict(url=twvdscli.api.base_url, updated=time(), items=SERVERS))
+    yield
+    twvdscli.load_config.cache_clear()
+
+
+@pytest.mark.parametrize('selector, ids', [
+    ('web-1', [1]),
+    ('web-*', [1, 2, 10]),
+    ('web-1*', [1, 10]),
+    ('name:web-?', [1, 2]),
+    ('ip:10.0.0.*', [1, 2]),
+    ('status=off', [2]),
+    ('status!=off', [1, 10, 20]),
+    ('ram>=4096', [2, 10]),
+    ('ram>4096', [10]),
+    ('ram<2048', [1]),
+    ('cpus<=2', [1, 2, 20]),
+    ('web-*,status=on', [1, 10]),
+    (' web-* , ram>1024 ', [2, 10]),
+    ('nothing-*', []),
+])
+def test_selector(selector, ids):
+    assert matching(selector) == ids
+
+
+def test_selector_numbers_are_compared_as_numbers():
+    # As strings '10' < '9', as numbers it is not
+    assert matching('id>9') == [10, 20]
+    assert matching('ram=1024.0') == [1]
+
+
+def test_selector_strings_are_compared_as_strings():
+    assert matching('name>web') == [1, 2, 10]
+
+
+def test_selector_pattern_is_case_sensitive():
+    assert matching('WEB-*') == []
+
+
+def test_selector_pattern_does_not_match_empty_field():
+    assert matching('ip:*') == [1, 2, 10]
+
+
+def test_selector_unknown_field():
+    with pytest.raises(ValueError, match='Unknown field in selector: color'):
+        matching('color=red')
+
+
+def test_resolve_number_is_id_as_is(index):
+    assert twvdscli.resolve('vds', ' 12345 ') == [12345]
+
+
+def test_resolve_selector(index):
+    assert twvdscli.resolve('vds', 'web-*,status=on') == [1, 10]
+
+
+def test_resolve_nothing_matches(index, capsys):
+    with pytest.raises(SystemExit):
+        twvdscli.resolve('vds', 'nothing-*')
+    assert 'Nothing matches: nothing-*' in capsys.readouterr().out
+
+
+def test_resolve_unknown_field(index, capsys):
+    with pytest.raises(SystemExit):
+        twvdscli.resolve('vds', 'color=red')
+    assert 'Unknown field in selector: color' in capsys.readouterr().out
+
+
+def test_get_id_must_match_one(index, capsys):
+    assert twvdscli.get_id('db-main') == 20
+    with pytest.raises(SystemExit):
+        twvdscli.get_id('web-*')
+    assert 'matches 3' in capsys.readouterr().out
+
+
+def test_get_ids_keeps_order_without_duplicates(index):
+    assert twvdscli.get_ids(['10', 'web-*', '20']) == [10, 1, 2, 20]
+
+
+def test_fuzzy_score():
+    assert twvdscli.fuzzy_score('', 'anything') == (0, 0)
+    assert twvdscli.fuzzy_score('wb1', 'web-1') == (4, 0)
+    assert twvdscli.fuzzy_score('xyz', 'web-1') is None
+    assert twvdscli.fuzzy_score('1w', 'web-1') is None
+    # Closer match is better, then earlier one
+    assert twvdscli.fuzzy_score('web', 'web-1') < twvdscli.fuzzy_score('web', 'w-e-b')
+    assert twvdscli.fuzzy_score('db', 'db web') < twvdscli.fuzzy_score('db', 'web db')
+
+
+def backups(*ages):
+    """
+    Backups made ages (days) ago, ids are ages
+    """
+    from datetime import datetime, timezone
+    return [dict(id=age, c_date=datetime.fromtimestamp(time() - age * 86400, timezone.utc).isoformat())
+            for age in ages]
+
+
+def test_expired_backups_keep():
+    assert [i['id'] for i in twvdscli.expired_backups(backups(3, 1, 5, 2), keep=2)] == [3, 5]
+    assert twvdscli.expired_backups(backups(1, 2), keep=5) == []
+    assert [i['id'] for i in twvdscli.expired_backups(backups(1, 2), keep=0)] == [1, 2]
+
+
+def test_expired_backups_older_than():
+    assert [i['id'] for i in twvdscli.expired_backups(backups(1, 10, 5), older_than=4)] == [5, 10]
+
+
+def test_expired_backups_keep_and_older_than():
+    assert [i['id'] for i in twvdscli.expired_backups(backups(1, 2, 10, 20), keep=3, older_than=4)] == [20]
+
+
+class Response:
+    def __init__(self, retry_after=None):
+        self.headers = {} if retry_after is None else {'Retry-After': retry_after}
+
+
+def test_retry_after():
+    assert twvdscli.retry_after(Response()) is None
+    assert twvdscli.retry_after(Response('2')) == 2
+    assert twvdscli.retry_after(Response('-5')) == 0
+    assert twvdscli.retry_after(Response('100000')) == twvdscli.RETRY_MAX_DELAY
+    assert twvdscli.retry_after(Response('soon')) is None
+
+
+def test_retry_after_http_date():
+    from email.utils import formatdate
+    assert 5 < twvdscli.retry_after(Response(formatdate(time() + 10, usegmt=True))) <= 10
+
+
+def task(outcome, detail=None):
+    return lambda: (outcome, detail)
+
+
+def test_run_dag_order_and_skip():
+    done = []
+
+    def request(key, outcome='ready'):
+        def run():
+            done.append(key)
+            return outcome, None
+        return run
+
+    tasks = dict(
+        a=((), request('a'), None),
+        b=(('a',), request('b', 'error'), None),
+        c=(('b',), request('c'), None),
+        d=(('a',), request('d'), None),
+    )
+    results = dict((key, outcome) for key, outcome, detail in twvdscli.run_dag(tasks, 2))
+    assert results == dict(a='ready', b='error', c='skipped', d='ready')
+    assert done.index('a') < done.index('b') and done.index('a') < done.index('d')
+    assert 'c' not in done
+
+
+def test_run_dag_complete_phase():
+    tasks = dict(
+        a=((), task('requested', 7), lambda detail: ('ready', detail * 2)),
+        b=(('a',), task('ready'), None),
+    )
+    assert list(twvdscli.run_dag(tasks, 1)) == [('a', 'ready', 14), ('b', 'ready', None)]
+
+
+def test_run_dag_cycle():
+    tasks = dict(
+        a=((), task('ready'), None),
+        b=(('c',), task('ready'), None),
+        c=(('b',), task('ready'), None),
+    )
+    results = sorted(twvdscli.run_dag(tasks))
+    assert results == [('a', 'ready', None), ('b', 'skipped', 'dependency cycle'),
+                       ('c', 'skipped', 'dependency cycle')]
+
+
+def test_run_dag_exception_is_error():
+    def broken():
+        raise RuntimeError('boom')
+    assert list(twvdscli.run_dag(dict(a=((), broken, None)))) == [('a', 'error', 'boom')]
+
+
+class Page:
+    def __init__(self, body, ok=True):
+        self.body = body
+        self.ok = ok
+
+    def json(self):
+        return self.body
+
+
+def pages(monkeypatch, total_items, limit, meta=True, fail_at=None, ignore_limit=False):
+    """
+    Pages of paginate() over fake list endpoint, and offsets it was asked for
+    """
+    asked = []
+
+    def get(uri, params):
+        asked.append(params['offset'])
+        if params['offset'] == fail_at:
+            return Page(None, ok=False)
+        end = total_items if ignore_limit else params['offset'] + params['limit']
+        body = dict(items=list(range(total_items))[params['offset']:end])
+        if meta:
+            body['meta'] = dict(total=total_items)
+        return Page(body)
+
+    monkeypatch.setattr(twvdscli.api, 'get', get)
+    return list(twvdscli.paginate('/items', 'items', limit=limit, prefetch=False)), asked
+
+
+def test_paginate_stops_on_total(monkeypatch):
+    result, asked = pages(monkeypatch, 6, 3)
+    assert result == [[0, 1, 2], [3, 4, 5]]
+    assert asked == [0, 3]
+
+
+def test_paginate_stops_on_short_page_without_total(monkeypatch):
+    result, asked = pages(monkeypatch, 5, 3, meta=False)
+    assert result == [[0, 1, 2], [3, 4]]
+    assert asked == [0, 3]
+
+
+def test_paginate_api_ignoring_limit(monkeypatch):
+    result, asked = pages(monkeypatch, 5, 3, ignore_limit=True)
+    assert result == [[0, 1, 2, 3, 4]]
+    assert asked == [0]
+
+
+def test_paginate_failed_page(monkeypatch):
+    result, asked = pages(monkeypatch, 9, 3, fail_at=3)
+    assert result == [[0, 1, 2], None]
@@ -1,18 +1,28 @@
 #!/usr/bin/python3
 
+# requests, prettytable, asyncio, configparser and hashlib are imported where they are used:
+# they are slow to import and not needed for --help and shell completion
+import functools
 import json
 import sys
-import requests
 import typer
 import os
-import configparser
 import base64
-from prettytable import PrettyTable
-from typing import Optional
+import csv
+import random
+import threading
+import weakref
+from contextlib import contextmanager, nullcontext
+from enum import Enum
+from typing import List, Optional
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 # For spinning wheel
 from itertools import cycle
 from time import sleep
+from time import time
+from time import perf_counter
+from time import strftime
 
 
 app = typer.Typer()
@@ -36,6 +46,420 @@ servers_app.add_typer(snapshot_app, name='snap', help='Create/Rollback/Delete sn
 vds_info_app = typer.Typer()
 servers_app.add_typer(vds_info_app, name='info', help='Get info about plans and os\'es')
 
+# Catalogs cached on disk and default time to keep them (seconds)
+CATALOGS = dict(presets='/api/v1/presets', os='/api/v1/os')
+CATALOG_TTL = 24 * 3600
+# Local index of VDSes and DBs for selectors is refreshed by list commands,
+# dropped by changes made here and fetched again after index_ttl seconds (see [cache] section of config)
+INDEX_TTL = 300
+# Shell completion starts refresh of stale cache in background at most once in this many seconds
+COMPLETION_REFRESH = 60
+# Lines shown by interactive picker
+PICKER_ROWS = 10
+# SSH master connection is kept for reuse this long after last session, and connect timeout (seconds)
+SSH_PERSIST = '10m'
+SSH_CONNECT_TIMEOUT = 10
+
+# Access token lifetime if API did not tell us, and how long before expiry we stop trusting it
+TOKEN_TTL = 3600
+TOKEN_MARGIN = 60
+
+# Can be pointed to a mock API, see bench/mock_api.py
+API_URL = os.environ.get('TWVDSCLI_API_URL', 'https://public-api.timeweb.com').rstrip('/')
+# Max keep-alive connections to API, should cover concurrent workers
+POOL_SIZE = 32
+# Connect and read timeouts of API requests (seconds)
+CONNECT_TIMEOUT = 5
+READ_TIMEOUT = 30
+# Retries of failed requests, first and max delay between them (seconds).
+# 429 is retried for any method, 5xx and network errors only for idempotent ones.
+RETRIES = 4
+RETRY_DELAY = 0.5
+RETRY_MAX_DELAY = 30
+IDEMPOTENT = ('GET', 'HEAD', 'OPTIONS', 'PUT')
+# Client side rate limit shared by all workers: requests per second (0 is no limit) and burst
+RATE_LIMIT = 20
+RATE_BURST = 40
+
+# Waiting for status change: first delay, max delay, its growth and default timeout (seconds)
+WAIT_DELAY = 0.5
+WAIT_MAX_DELAY = 10
+WAIT_FACTOR = 1.5
+WAIT_TIMEOUT = 600
+# Statuses in which VDS will never reach the one we wait for
+VDS_FAILED = ('blocked', 'no_paid')
+# Items per page for list endpoints
+PAGE_SIZE = 100
+# Default number of VDSes processed at once by bulk commands
+BULK_CONCURRENCY = 8
+# Max API requests in flight for asyncio backend
+ASYNC_LIMIT = POOL_SIZE
+
+# VDS fields compared by vds list --watch
+WATCH_KEYS = ('status', 'ip', 'configuration')
+
+# Global options, see callback()
+settings = dict(output='table', interactive=True)
+
+
+class DeadlineExceeded(Exception):
+    """
+    Command ran out of time given with --deadline
+    """
+
+
+class RateLimiter:
+    """
+    Token bucket shared by all threads: rate requests per second with bursts up to burst.
+    Callers reserve a token and sleep until it is theirs, so waiting is fair.
+    """
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time()
+        self.lock = threading.Lock()
+
+    def acquire(self, limit=None):
+        """
+        Wait for token, but no more than limit seconds
+        """
+        if not self.rate:
+            return
+        with self.lock:
+            now = time()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= 1
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+        if limit is not None and wait > limit:
+            raise DeadlineExceeded("Deadline exceeded")
+        if wait:
+            sleep(wait)
+
+
+def backoff(attempt):
+    """
+    Exponential delay with jitter for retry number attempt
+    """
+    delay = min(RETRY_DELAY * 2 ** attempt, RETRY_MAX_DELAY)
+    return delay / 2 + random.uniform(0, delay / 2)
+
+
+def retry_after(result):
+    """
+    Seconds from Retry-After header (number or HTTP date), None if there is none
+    """
+    value = result.headers.get('Retry-After')
+    if not value:
+        return None
+    try:
+        return min(max(0, float(value)), RETRY_MAX_DELAY)
+    except ValueError:
+        pass
+    from email.utils import parsedate_to_datetime
+    try:
+        return min(max(0, parsedate_to_datetime(value).timestamp() - time()), RETRY_MAX_DELAY)
+    except (TypeError, ValueError):
+        return None
+
+
+class Client:
+    """
+    HTTP layer for backend: one keep-alive session with connection pool,
+    base URL and auth header. Endpoints are uri templates, fields are
+    substituted into them: api.get('/api/v2/vds/{vds_id}', vds_id=1)
+    """
+    def __init__(self, base_url=API_URL, pool_size=POOL_SIZE, rate=RATE_LIMIT, burst=RATE_BURST):
+        self.base_url = base_url
+        self.pool_size = pool_size
+        self.limiter = RateLimiter(rate, burst)
+        # Absolute time after which no requests are made, see --deadline
+        self.deadline = None
+        # Why last request failed, to tell user more than just "Error"
+        self.last_error = None
+        self._session = None
+        # Workers of bulk commands start at once, only one of them should log in
+        self.lock = threading.Lock()
+        # Successful GETs of this run (or batch): {(url, params): response}, see memo_get()
+        self.memo = dict()
+        self.memo_lock = threading.Lock()
+        # Threads inside fresh() do not read memo
+        self.local = threading.local()
+
+    @property
+    def session(self):
+        """
+        Session is made on first request, so commands that don't use API don't pay for it
+        """
+        if self._session is None:
+            with self.lock:
+                if self._session is None:
+                    import requests
+                    session = requests.Session()
+                    adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size)
+                    session.mount('https://', adapter)
+                    session.mount('http://', adapter)
+                    self._session = session
+        return self._session
+
+    def authorize(self, token):
+        self.session.headers['Authorization'] = "Bearer " + token
+
+    def request(self, method, uri, json=None, params=None, headers=None, reauth=True, retry=None, **fields):
+        """
+        Make request to API. We log in on first request (reauth=False is for auth itself).
+        Cached token may be revoked before it expires, so on 401 we get a new one and try once more.
+        """
+        url = self.base_url + uri.format(**fields)
+        memo_key = None
+        if method != 'GET':
+            self.forget(url)
+        elif not headers:
+            # GETs with headers are conditional (see get_catalog), they are neither read from memo nor saved there
+            memo_key = (url, tuple(sorted((params or {}).items())))
+            if not getattr(self.local, 'fresh', False):
+                # Deadline is for the command, not only for requests which go to network
+                self.remaining()
+                with self.memo_lock:
+                    result = self.memo.get(memo_key)
+                if result is not None:
+                    return result
+        if reauth and 'Authorization' not in self.session.headers:
+            with self.lock:
+                if 'Authorization' not in self.session.headers:
+                    login()
+        result = self.call(method, uri, url, retry, json=json, params=params, headers=headers)
+        if reauth and result.status_code == 401:
+            apikey = get_api_key(refresh=True)
+            if apikey is not None:
+                self.authorize(apikey)
+                result = self.call(method, uri, url, retry, json=json, params=params, headers=headers)
+        if not result.ok:
+            self.last_error = "{status} {reason} on {method} {uri}".format(
+                status=result.status_code, reason=result.reason, method=method, uri=uri)
+        elif memo_key is not None:
+            with self.memo_lock:
+                self.memo[memo_key] = result
+        return result
+
+    @staticmethod
+    def resource(url):
+        """
+        What URL is about: part of path after /api/vN, e.g. 'vds' for /api/v2/vds/1/start
+        """
+        parts = url.split('?')[0].split('/api/', 1)[-1].split('/')
+        return parts[1] if len(parts) > 1 else parts[0]
+
+    def forget(self, url=None):
+        """
+        Drop memoized GETs of the same resource as url (e.g. of all VDSes for POST /api/v1/vds/1/start),
+        everything if url is None. Called for every non-GET request, so nothing stale is read after change.
+        """
+        with self.memo_lock:
+            if url is None:
+                self.memo.clear()
+                return
+            resource = self.resource(url)
+            for key in [key for key in self.memo if self.resource(key[0]) == resource]:
+                del self.memo[key]
+
+    @contextmanager
+    def fresh(self):
+        """
+        GETs of this thread within the block go to API, for polling.
+        Their results are still memoized, so later reads see the latest state.
+        """
+        previous = getattr(self.local, 'fresh', False)
+        self.local.fresh = True
+        try:
+            yield
+        finally:
+            self.local.fresh = previous
+
+    def remaining(self):
+        """
+        Seconds left before deadline, None if there is no deadline
+        """
+        if self.deadline is None:
+            return None
+        left = self.deadline - time()
+        if left <= 0:
+            raise DeadlineExceeded("Deadline exceeded")
+        return left
+
+    def call(self, method, uri, url, retry=None, **kwargs):
+        """
+        Request with rate limit, timeouts and retries with exponential backoff.
+        Retry-After of 429/503 is honoured. retry=None means retry only idempotent methods.
+        """
+        import requests
+        if retry is None:
+            retry = method in IDEMPOTENT
+        attempt = 0
+        while True:
+            self.limiter.acquire(self.remaining())
+            timeout = (CONNECT_TIMEOUT, READ_TIMEOUT)
+            left = self.remaining()
+            if left is not None:
+                timeout = (min(CONNECT_TIMEOUT, left), min(READ_TIMEOUT, left))
+            try:
+                result = self.send(method, uri, url, timeout=timeout, **kwargs)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                if not retry or attempt >= RETRIES:
+                    self.last_error = "{error} on {method} {uri}".format(error=e.__class__.__name__,
+                                                                         method=method, uri=uri)
+                    raise
+                delay = backoff(attempt)
+            else:
+                if result.status_code == 429 or (retry and result.status_code >= 500):
+                    if attempt >= RETRIES:
+                        return result
+                    delay = retry_after(result)
+                    if delay is None:
+                        delay = backoff(attempt)
+                else:
+                    return result
+            left = self.remaining()
+            if left is not None and delay >= left:
+                raise DeadlineExceeded("Deadline exceeded")
+            sleep(delay)
+            attempt += 1
+
+    def send(self, method, uri, url, **kwargs):
+        """
+        One HTTP request, timed and recorded by tracer if it is on
+        """
+        if not tracer.enabled:
+            return self.session.request(method, url, **kwargs)
+        start = perf_counter()
+        status, size = 'error', 0
+        try:
+            result = self.session.request(method, url, **kwargs)
+            status, size = result.status_code, len(result.content)
+            return result
+        finally:
+            tracer.record(method, uri, status, size, perf_counter() - start)
+
+    def get(self, uri, **kwargs):
+        return self.request('GET', uri, **kwargs)
+
+    def post(self, uri, **kwargs):
+        return self.request('POST', uri, **kwargs)
+
+    def put(self, uri, **kwargs):
+        return self.request('PUT', uri, **kwargs)
+
+    def delete(self, uri, **kwargs):
+        return self.request('DELETE', uri, **kwargs)
+
+
+class Tracer:
+    """
+    Records of API calls: method, endpoint (uri template), status, response bytes, latency.
+    --trace writes them as JSON lines while command runs, --timings prints summary
+    per endpoint to stderr, --prometheus writes textfile for node_exporter.
+    """
+    def __init__(self):
+        self.enabled = False
+        self.records = []
+        self.trace_file = None
+        self.started = time()
+        self.lock = threading.Lock()
+
+    def record(self, method, endpoint, status, size, seconds):
+        record = dict(ts=round(time(), 3), method=method, endpoint=endpoint, status=status,
+                      bytes=size, seconds=round(seconds, 6))
+        with self.lock:
+            self.records.append(record)
+            if self.trace_file:
+                self.trace_file.write(json.dumps(record) + '\n')
+                self.trace_file.flush()
+
+    def endpoints(self):
+        """
+        {(method, endpoint): sorted latencies}
+        """
+        result = dict()
+        for i in self.records:
+            result.setdefault((i['method'], i['endpoint']), []).append(i['seconds'])
+        for latencies in result.values():
+            latencies.sort()
+        return result
+
+    def summary(self):
+        """
+        Print count, p50, p95 and total time per endpoint to stderr
+        """
+        from prettytable import PrettyTable
+        x = PrettyTable()
+        x.field_names = ['method', 'endpoint', 'count', 'p50 ms', 'p95 ms', 'total ms']
+        x.align['endpoint'] = 'l'
+        for (method, endpoint), latencies in sorted(self.endpoints().items()):
+            x.add_row([method, endpoint, len(latencies), ms(percentile(latencies, 50)),
+                       ms(percentile(latencies, 95)), ms(sum(latencies))])
+        print(x, file=sys.stderr)
+        print("API calls: {calls}, command time: {total} ms".format(
+            calls=len(self.records), total=ms(time() - self.started)), file=sys.stderr)
+
+    def write_prometheus(self, path):
+        """
+        Prometheus textfile, written atomically as textfile collector wants
+        """
+        lines = [
+            '# HELP twvdscli_api_requests_total API requests made by twvdscli run.',
+            '# TYPE twvdscli_api_requests_total counter',
+        ]
+        statuses = dict()
+        for i in self.records:
+            key = (i['method'], i['endpoint'], str(i['status']))
+            statuses[key] = statuses.get(key, 0) + 1
+        for (method, endpoint, status), count in sorted(statuses.items()):
+            lines.append('twvdscli_api_requests_total{{method="{}",endpoint="{}",status="{}"}} {}'.format(
+                method, endpoint, status, count))
+        lines += [
+            '# HELP twvdscli_api_request_seconds Latency of API requests.',
+            '# TYPE twvdscli_api_request_seconds summary',
+        ]
+        for (method, endpoint), latencies in sorted(self.endpoints().items()):
+            labels = 'method="{}",endpoint="{}"'.format(method, endpoint)
+            for q in (0.5, 0.95):
+                lines.append('twvdscli_api_request_seconds{{{},quantile="{}"}} {}'.format(
+                    labels, q, percentile(latencies, q * 100)))
+            lines.append('twvdscli_api_request_seconds_sum{{{}}} {}'.format(labels, sum(latencies)))
+            lines.append('twvdscli_api_request_seconds_count{{{}}} {}'.format(labels, len(latencies)))
+        lines += [
+            '# HELP twvdscli_api_response_bytes_total Bytes received from API.',
+            '# TYPE twvdscli_api_response_bytes_total counter',
+            'twvdscli_api_response_bytes_total {}'.format(sum(i['bytes'] for i in self.records)),
+            '# HELP twvdscli_run_seconds Duration of twvdscli run.',
+            '# TYPE twvdscli_run_seconds gauge',
+            'twvdscli_run_seconds {}'.format(time() - self.started),
+            '# HELP twvdscli_last_run_timestamp_seconds When twvdscli run finished.',
+            '# TYPE twvdscli_last_run_timestamp_seconds gauge',
+            'twvdscli_last_run_timestamp_seconds {}'.format(time()),
+        ]
+        with open(path + '.tmp', 'w') as promfile:
+            promfile.write('\n'.join(lines) + '\n')
+        os.replace(path + '.tmp', path)
+
+
+def percentile(values, p):
+    """
+    Nearest-rank percentile of sorted values
+    """
+    if not values:
+        return 0
+    return values[max(0, min(len(values) - 1, int(round(p / 100 * len(values) + 0.5)) - 1))]
+
+
+def ms(seconds):
+    return round(seconds * 1000, 1)
+
+
+tracer = Tracer()
+api = Client()
+
 
 class Dbaas:
     """
@@ -43,42 +467,40 @@ class Dbaas:
     """
     @staticmethod
     def list():
-        url = 'https://public-api.timeweb.com/api/v1/dbs'
-        result = requests.get(
-            url=url,
-            headers=reqHeader
-        )
+        uri = '/api/v1/dbs'
+        result = api.get(uri)
         if not result.ok:
             return None
         return result.json()
 
+    @staticmethod
+    def iter_pages(limit=PAGE_SIZE, prefetch=True):
+        """
+        Iterate over list of DBs page by page, see paginate()
+        """
+        return paginate('/api/v1/dbs', 'dbs', limit=limit, prefetch=prefetch)
+
     @staticmethod
     def get(db_id):
-        url = 'https://public-api.timeweb.com/api/v1/dbs/{db_id}'
-        result = requests.get(
-            url=url.format(db_id=db_id),
-            headers=reqHeader
-        )
+        uri = '/api/v1/dbs/{db_id}'
+        result = api.get(uri, db_id=db_id)
         if not result.ok:
             return None
         return result.json()
 
     @staticmethod
     def create(passwd, name, db_type):
-        url = 'https://public-api.timeweb.com/api/v1/dbs'
+        uri = '/api/v1/dbs'
         if db_type == 'postgres':
             service_type = 357
         else:
             service_type = 341
         data = dict(host="%", login="user", password=passwd, name=name, type=db_type,
                     hash_type="caching_sha2", service_type=service_type)
-        result = requests.post(
-            url=url,
-            json=data,
-            headers=reqHeader
-        )
+        result = api.post(uri, json=data)
         if not result.ok:
             return None
+        index_drop('dbs')
         return result.json()
 
 
@@ -93,27 +515,81 @@ class Server:
         """
         Get list of VDSs'
         """
-        url = 'https://public-api.timeweb.com/api/v2/vds'
-        result = requests.get(
-            url=url,
-            headers=reqHeader
-        )
+        uri = '/api/v2/vds'
+        result = api.get(uri)
         if not result.ok:
             return None
         return result.json()
 
+    @staticmethod
+    def iter_pages(limit=PAGE_SIZE, prefetch=True):
+        """
+        Iterate over list of VDSs' page by page, see paginate()
+        """
+        return paginate('/api/v2/vds', 'servers', limit=limit, prefetch=prefetch)
+
+    @staticmethod
+    def iter_list(limit=PAGE_SIZE, prefetch=True):
+        """
+        Iterate over VDSs' without loading all of them at once
+        """
+        for page in Server.iter_pages(limit=limit, prefetch=prefetch):
+            if page is None:
+                return
+            yield from page
+
     @staticmethod
     def get_vds(vds_id):
         """
         Get VDS info
         """
-        url = "https://public-api.timeweb.com/api/v2/vds/{vds_id}".format(vds_id=vds_id)
-        result = requests.get(
-            url=url,
-            headers=reqHeader
-        )
+        uri = "/api/v2/vds/{vds_id}"
+        result = api.get(uri, vds_id=vds_id)
+        if not result.ok:
+            return None
+        return result.json()
+
+    @staticmethod
+    def create(name, os_id, preset, comment="", group_id=None):
+        """
+        Create VDS
+        """
+        data = {
+          "server": {
+            "configuration": {
+              "caption": name,
+              # "disk_size": 5, # dont give a fuck
+              # "network_bandwidth": 100, # dont give a fuck
+              "os": os_id, # 47 - ubuntu 18.04
+              # "xen_cpu": 2, # dont give a fuck
+              # "xen_ram": 4096, # dont give a fuck
+              "ddos_guard": False
+            },
+            "comment": comment,
+            "group_id": group_id, # /api/v1/accounts/{user}/group
+            "name": "string", # what is this for?
+            "preset_id": preset, # you can not create vds without this, but how to create flexible vds? (preset example: 20)
+            "install_ssh_key": "",
+            "server_id": None,
+            "local_networks": []
+            }
+        }
+        result = api.post("/api/v1/vds", json=data)
         if not result.ok:
             return None
+        index_drop('vds')
+        return result.json()
+
+    @staticmethod
+    def rename(vds_id, name):
+        """
+        Set name of VDS (clones get name of source)
+        """
+        uri = "/api/v1/vds/{id}"
+        result = api.put(uri, id=vds_id, json={"server": {"name": name}})
+        if not result.ok:
+            return None
+        index_drop('vds')
         return result.json()
 
     @staticmethod
@@ -121,14 +597,13 @@ class Server:
         """
         Start VDS
         """
-        uri = "https://public-api.timeweb.com/api/v1/vds/{id}/{action}"
-        result = requests.post(
-            uri.format(id=vds_id, action='start'),
-            headers=reqHeader
-        )
+        uri = "/api/v1/vds/{id}/{action}"
+        # Safe to repeat, so retried like GET
+        result = api.post(uri, id=vds_id, action='start', retry=True)
         if not result.ok:
             return None
         else:
+            index_drop('vds')
             return result.json()
 
     @staticmethod
@@ -136,14 +611,13 @@ class Server:
         """
         Stop VDS
         """
-        uri = "https://public-api.timeweb.com/api/v1/vds/{id}/{action}"
-        result = requests.post(
-            uri.format(id=vds_id, action='shutdown'),
-            headers=reqHeader
-        )
+        uri = "/api/v1/vds/{id}/{action}"
+        # Safe to repeat, so retried like GET
+        result = api.post(uri, id=vds_id, action='shutdown', retry=True)
         if not result.ok:
             return None
         else:
+            index_drop('vds')
             return result.json()
 
     @staticmethod
@@ -151,14 +625,12 @@ class Server:
         """
         Clone VDS
         """
-        uri = "https://public-api.timeweb.com/api/v1/vds/{id}/{action}"
-        result = requests.post(
-            uri.format(id=vds_id, action='clone'),
-            headers=reqHeader
-        )
+        uri = "/api/v1/vds/{id}/{action}"
+        result = api.post(uri, id=vds_id, action='clone')
         if not result.ok:
             return None
         else:
+            index_drop('vds')
             return result.json()
 
     @staticmethod
@@ -166,55 +638,70 @@ class Server:
         """
         Remove VDS
         """
-        uri = "https://public-api.timeweb.com/api/v1/vds/{id}"
-        result = requests.delete(
-            uri.format(id=vds_id),
-            headers=reqHeader
-        )
+        uri = "/api/v1/vds/{id}"
+        result = api.delete(uri, id=vds_id)
         if not result.ok:
             return None
         else:
+            index_drop('vds')
             return result.json()
 
 
 class Backups:
     @staticmethod
-    def create(vds_id):
-        disk_id = Server.get_vds(vds_id)['server']['disk_stats']['disk_id']
+    def disk_id(vds_id):
+        """
+        ID of main disk of VDS, backups are made of it.
+        It does not change, so local index is good for it whatever old it is.
+        """
+        records, _ = index_cached('vds')
+        disk_id = next((i.get('disk_id') for i in records or [] if i['id'] == vds_id), None)
+        if disk_id is not None:
+            return disk_id
+        vds = Server.get_vds(vds_id)
+        if vds is None:
+            return None
+        return vds['server']['disk_stats']['disk_id']
 
-        uri = "https://public-api.timeweb.com/api/v1/backups/vds/{id}/drive/{disk_id}"
-        result = requests.post(
-            uri.format(id=vds_id, disk_id=disk_id),
-            headers=reqHeader
-        )
+    @staticmethod
+    def create(vds_id, disk_id=None):
+        if disk_id is None:
+            disk_id = Backups.disk_id(vds_id)
+            if disk_id is None:
+                return None
+
+        uri = "/api/v1/backups/vds/{id}/drive/{disk_id}"
+        result = api.post(uri, id=vds_id, disk_id=disk_id)
         if result.ok:
+            index_drop('backups')
             return result.json()
         else:
             return None
 
     @staticmethod
-    def list(vds_id):
-        disk_id = Server.get_vds(vds_id)['server']['disk_stats']['disk_id']
-        uri = "https://public-api.timeweb.com/api/v1/backups/vds/{id}/drive/{disk_id}"
-        result = requests.get(
-            uri.format(id=vds_id, disk_id=disk_id),
-            headers=reqHeader
-        )
+    def list(vds_id, disk_id=None):
+        if disk_id is None:
+            disk_id = Backups.disk_id(vds_id)
+            if disk_id is None:
+                return None
+        uri = "/api/v1/backups/vds/{id}/drive/{disk_id}"
+        result = api.get(uri, id=vds_id, disk_id=disk_id)
         if result.ok:
             return result.json()
         else:
             return None
 
     @staticmethod
-    def remove(vds_id, backup_id):
-        disk_id = Server.get_vds(vds_id)['server']['disk_stats']['disk_id']
-
-        uri = "https://public-api.timeweb.com/api/v1/backups/{backup_id}/vds/{id}/drive/{disk_id}"
-        result = requests.delete(
-            uri.format(id=vds_id, disk_id=disk_id, backup_id=backup_id),
-            headers=reqHeader
-        )
+    def remove(vds_id, backup_id, disk_id=None):
+        if disk_id is None:
+            disk_id = Backups.disk_id(vds_id)
+            if disk_id is None:
+                return None
+
+        uri = "/api/v1/backups/{backup_id}/vds/{id}/drive/{disk_id}"
+        result = api.delete(uri, id=vds_id, disk_id=disk_id, backup_id=backup_id)
         if result.ok:
+            index_drop('backups')
             return result.json()
         else:
             return None
@@ -223,23 +710,29 @@ class Backups:
 class Snapshots:
     @staticmethod
     def get(vds_id):
-        uri = "https://public-api.timeweb.com/api/v1/restore-points/{vds_id}"
-        result = requests.get(
-            uri.format(vds_id=vds_id),
-            headers=reqHeader
-        )
+        uri = "/api/v1/restore-points/{vds_id}"
+        result = api.get(uri, vds_id=vds_id)
         if result.ok:
             return result.json()
         else:
             return None
 
+    @staticmethod
+    def find(vds_id):
+        """
+        Like get(), but {} if VDS has no restore point (404), other errors raise requests.HTTPError
+        """
+        uri = "/api/v1/restore-points/{vds_id}"
+        result = api.get(uri, vds_id=vds_id)
+        if result.status_code == 404:
+            return {}
+        result.raise_for_status()
+        return result.json()
+
     @staticmethod
     def create(vds_id):
-        uri = "https://public-api.timeweb.com/api/v1/restore-points/{vds_id}/create"
-        result = requests.post(
-            uri.format(vds_id=vds_id),
-            headers=reqHeader
-        )
+        uri = "/api/v1/restore-points/{vds_id}/create"
+        result = api.post(uri, vds_id=vds_id)
         if result.ok:
             return result.json()
         else:
@@ -247,11 +740,8 @@ class Snapshots:
 
     @staticmethod
     def remove(vds_id):
-        uri = "https://public-api.timeweb.com/api/v1/restore-points/{vds_id}/commit"
-        result = requests.post(
-            uri.format(vds_id=vds_id),
-            headers=reqHeader
-        )
+        uri = "/api/v1/restore-points/{vds_id}/commit"
+        result = api.post(uri, vds_id=vds_id)
         if result.ok:
             return result.json()
         else:
@@ -259,137 +749,1263 @@ class Snapshots:
 
     @staticmethod
     def restore(vds_id):
-        uri = "https://public-api.timeweb.com/api/v1/restore-points/{vds_id}/rollback"
-        result = requests.post(
-            uri.format(vds_id=vds_id),
-            headers=reqHeader
-        )
+        uri = "/api/v1/restore-points/{vds_id}/rollback"
+        result = api.post(uri, vds_id=vds_id)
         if result.ok:
             return result.json()
         else:
             return None
 
 
+def paginate(uri, key, limit=PAGE_SIZE, prefetch=True):
+    """
+    Generator of pages (lists of result[key]) of list endpoint, using limit/offset.
+    With prefetch next page is requested while caller processes current one.
+    Yields None and stops if request failed.
+    """
+    # Prefetch runs in another thread, which must read fresh pages too if we were asked for them
+    fresh = getattr(api.local, 'fresh', False)
+
+    def fetch(offset):
+        with api.fresh() if fresh else nullcontext():
+            result = api.get(uri, params=dict(limit=limit, offset=offset))
+        if not result.ok:
+            return None
+        return result.json()
+
+    pool = ThreadPoolExecutor(max_workers=1) if prefetch else None
+    try:
+        offset = 0
+        result = fetch(offset)
+        while True:
+            if result is None:
+                yield None
+                return
+            page = result.get(key, [])
+            total = result.get('meta', {}).get('total')
+            offset += len(page)
+            # Stop on short page, on known total, or if API ignored limit and gave us everything
+            more = len(page) == limit and (total is None or offset < total)
+            if more:
+                following = pool.submit(fetch, offset) if pool else None
+            yield page
+            if not more:
+                return
+            result = following.result() if following else fetch(offset)
+    finally:
+        if pool:
+            pool.shutdown(wait=False)
+
+
+class TableStream:
+    """
+    PrettyTable printed by chunks of rows as soon as they are available, header is printed once.
+    Widths of columns are set by the first chunk (or by widths asked for, if they are more),
+    longer values of later chunks are cut to them, so that borders of all rows are in line.
+    """
+    def __init__(self, field_names, widths=None):
+        self.field_names = field_names
+        self.widths = dict(zip(field_names, widths or []))
+        self.border = None
+
+    @staticmethod
+    def fit(value, width):
+        """
+        Value cut to width (every line of it), colors are lost if it is cut
+        """
+        lines = []
+        for line in str(value).split('\n'):
+            if len(typer.unstyle(line)) > width:
+                line = typer.unstyle(line)[:max(0, width - 1)] + '…'
+            lines.append(line)
+        return '\n'.join(lines)
+
+    def add_rows(self, rows):
+        if not rows:
+            return
+        from prettytable import PrettyTable
+        x = PrettyTable()
+        x.field_names = self.field_names
+        x.min_width.update(self.widths)
+        x.header = self.border is None
+        for row in rows:
+            if self.border is not None:
+                row = [self.fit(value, self.widths[name]) for name, value in zip(self.field_names, row)]
+            x.add_row(row)
+        lines = x.get_string().splitlines()
+        if x.header:
+            # remember width of columns from border line: +----+-------+
+            self.border = lines[-1]
+            for name, segment in zip(self.field_names, self.border.split('+')[1:-1]):
+                self.widths[name] = len(segment) - 2
+            print('\n'.join(lines[:-1]), flush=True)
+        else:
+            print('\n'.join(lines[1:-1]), flush=True)
+
+    def close(self):
+        if self.border is None:
+            # Nothing was printed, empty table
+            from prettytable import PrettyTable
+            x = PrettyTable()
+            x.field_names = self.field_names
+            print(x)
+        else:
+            print(self.border)
+
+
+class OutputFormat(str, Enum):
+    table = 'table'
+    json = 'json'
+    ndjson = 'ndjson'
+    csv = 'csv'
+
+
+class Output:
+    """
+    Records (dicts) printed in format chosen with global --output:
+    table - PrettyTable with headers, row is pretty(record) or values of fields;
+    json - one document, list of records (or a record if one is set);
+    ndjson, csv - line per record, printed as soon as record is added.
+    Table rows are printed on flush() (e.g. page by page), json on close().
+    widths {field: chars} are least widths of table columns, for tables flushed row by row (see TableStream).
+    """
+    def __init__(self, fields, headers=None, pretty=None, one=False, widths=None):
+        self.format = settings['output']
+        self.fields = fields
+        self.pretty = pretty
+        self.one = one
+        self.rows = []
+        if self.format == 'table':
+            self.table = TableStream(headers or fields, [(widths or {}).get(i, 0) for i in fields])
+        elif self.format == 'csv':
+            self.writer = csv.writer(sys.stdout)
+            self.writer.writerow(fields)
+
+    def add(self, record):
+        if self.format == 'table':
+            if self.pretty:
+                self.rows.append(self.pretty(record))
+            else:
+                self.rows.append([record.get(i) for i in self.fields])
+        elif self.format == 'json':
+            self.rows.append(record)
+        elif self.format == 'ndjson':
+            print(json.dumps(record), flush=True)
+        elif self.format == 'csv':
+            self.writer.writerow([csv_cell(record.get(i)) for i in self.fields])
+            sys.stdout.flush()
+
+    def flush(self):
+        if self.format == 'table':
+            self.table.add_rows(self.rows)
+            self.rows = []
+
+    def close(self):
+        if self.format == 'table':
+            self.flush()
+            self.table.close()
+        elif self.format == 'json':
+            if self.one:
+                print(json.dumps(self.rows[0] if self.rows else None))
+            else:
+                print(json.dumps(self.rows))
+
+
+def csv_cell(value):
+    if value is None:
+        return ''
+    if isinstance(value, (dict, list)):
+        return json.dumps(value)
+    return value
+
+
+def done(message, color=typer.colors.GREEN, **record):
+    """
+    Command succeeded: colored message for table output, record otherwise
+    """
+    if settings['output'] == 'table':
+        print(typer.style(message, fg=color))
+    else:
+        x = Output(list(record), one=True)
+        x.add(record)
+        x.close()
+
+
+def error(message="Error", **record):
+    """
+    Command failed: red message for table output, record with error otherwise. Exits with 1.
+    """
+    if message == "Error" and api.last_error:
+        message += ": " + api.last_error
+    if settings['output'] == 'table':
+        print(typer.style(message, fg=typer.colors.RED))
+    else:
+        record = dict(error=message, **record)
+        x = Output(list(record), one=True)
+        x.add(record)
+        x.close()
+    sys.exit(1)
+
+
+class AsyncBackend:
+    """
+    asyncio version of backend class (Server, Dbaas, Backups, Snapshots):
+    same methods with same arguments and results, but they are coroutines,
+    so hundreds of calls can be gathered over one event loop:
+
+        await asyncio.gather(*(AsyncServer.get_vds(i) for i in ids))
+
+    Calls share the pooled session, no more than ASYNC_LIMIT of them are in flight.
+    """
+    executor = None
+    semaphores = weakref.WeakKeyDictionary()
+
+    def __init__(self, backend):
+        self.backend = backend
+
+    @classmethod
+    def limit(cls, loop):
+        """
+        Semaphore is bound to event loop, so there is one per loop
+        """
+        import asyncio
+        if loop not in cls.semaphores:
+            cls.semaphores[loop] = asyncio.BoundedSemaphore(ASYNC_LIMIT)
+        return cls.semaphores[loop]
+
+    @classmethod
+    async def call(cls, func, *args, **kwargs):
+        import asyncio
+        loop = asyncio.get_running_loop()
+        if cls.executor is None:
+            cls.executor = ThreadPoolExecutor(max_workers=ASYNC_LIMIT, thread_name_prefix='twvdscli')
+        async with cls.limit(loop):
+            return await loop.run_in_executor(cls.executor, functools.partial(func, *args, **kwargs))
+
+    def __getattr__(self, name):
+        func = getattr(self.backend, name)
+
+        async def method(*args, **kwargs):
+            return await self.call(func, *args, **kwargs)
+        method.__name__ = name
+        method.__doc__ = func.__doc__
+        return method
+
+
+AsyncServer = AsyncBackend(Server)
+AsyncDbaas = AsyncBackend(Dbaas)
+AsyncBackups = AsyncBackend(Backups)
+AsyncSnapshots = AsyncBackend(Snapshots)
+
+
+async def gather_map(method, items):
+    """
+    Call async backend method for every item concurrently, results are in order of items
+    """
+    import asyncio
+    return await asyncio.gather(*(method(i) for i in items))
+
+
+def wait_for(fetch, ready, failed=None, timeout=WAIT_TIMEOUT, spinner=None):
+    """
+    Poll fetch() until ready(state) is true, failed(state) is true or timeout (seconds) passes.
+    Delay between polls grows exponentially from WAIT_DELAY up to WAIT_MAX_DELAY,
+    with jitter so that many waiters do not hit API in the same moment.
+    Network errors are not fatal, we just keep polling.
+    Spinner is shown by default only for table output, it would break machine readable one.
+    Returns ('ready' | 'failed' | 'timeout', last state)
+    """
+    import requests
+    if spinner is None:
+        spinner = settings['output'] == 'table'
+    deadline = time() + timeout
+    if api.deadline is not None:
+        deadline = min(deadline, api.deadline)
+    delay = WAIT_DELAY
+    frames = cycle(r'-\|/')
+    state = None
+    try:
+        while True:
+            try:
+                with api.fresh():
+                    state = fetch()
+            except requests.RequestException:
+                pass
+            else:
+                if ready(state):
+                    outcome = 'ready'
+                    break
+                if failed is not None and failed(state):
+                    outcome = 'failed'
+                    break
+            if time() >= deadline:
+                outcome = 'timeout'
+                break
+            # Sleep with jitter, but keep the wheel spinning
+            wake = min(time() + delay / 2 + random.uniform(0, delay / 2), deadline)
+            while time() < wake:
+                if spinner:
+                    print('\r', next(frames), sep='', end='', flush=True)
+                sleep(min(0.1, max(0, wake - time())))
+            delay = min(delay * WAIT_FACTOR, WAIT_MAX_DELAY)
+    finally:
+        # Wheel is wiped out on errors (e.g. deadline) too
+        if spinner:
+            print('\r \r', end='', flush=True)
+    return outcome, state
+
+
+def vds_status(state):
+    if not state or not state.get('server'):
+        return None
+    return state['server']['status']
+
+
+def wait_vds(vds_id, status, timeout=WAIT_TIMEOUT, spinner=None):
+    """
+    Wait until VDS has status, status None means wait until it is gone
+    """
+    def fetch():
+        # Only 404 is "gone", other errors (5xx, 429 left after retries) are not an answer, we keep polling
+        result = api.get("/api/v2/vds/{vds_id}", vds_id=vds_id)
+        if result.status_code == 404:
+            return dict(server=None)
+        result.raise_for_status()
+        return result.json()
+
+    if status is None:
+        ready = lambda state: state['server'] is None
+    else:
+        ready = lambda state: vds_status(state) == status
+    return wait_for(
+        fetch,
+        ready,
+        failed=lambda state: vds_status(state) in VDS_FAILED,
+        timeout=timeout,
+        spinner=spinner
+    )
+
+
+def wait_db(db_id, timeout=WAIT_TIMEOUT, spinner=None):
+    """
+    Wait until DB is started
+    """
+    return wait_for(
+        lambda: Dbaas.get(db_id),
+        lambda state: bool(state) and state['db']['status'] == 'started',
+        timeout=timeout,
+        spinner=spinner
+    )
+
+
+class Poller:
+    """
+    Waits for many VDSes (or DBs, kind 'dbs') at once, e.g. from workers of a pool: one list call per tick
+    tells status of all of them, instead of get_vds() per VDS per tick.
+    Polling thread runs while somebody waits. Delay between ticks grows like in wait_for()
+    and is reset when a new VDS is waited for.
+    """
+    def __init__(self, kind='vds'):
+        self.kind = kind
+        self.failed = VDS_FAILED if kind == 'vds' else ()
+        self.lock = threading.Lock()
+        self.pending = []
+        self.thread = None
+        self.fresh = False
+
+    def wait(self, vds_id, status, timeout=WAIT_TIMEOUT):
+        """
+        Like wait_vds(): wait until VDS has status, None means until it is gone.
+        Returns ('ready' | 'failed' | 'timeout', last status)
+        """
+        deadline = time() + timeout
+        if api.deadline is not None:
+            deadline = min(deadline, api.deadline)
+        target = dict(id=vds_id, status=status, deadline=deadline, event=threading.Event(), result=('timeout', None))
+        with self.lock:
+            self.pending.append(target)
+            self.fresh = True
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, daemon=True)
+                self.thread.start()
+        target['event'].wait()
+        return target['result']
+
+    def poll(self):
+        """
+        {id: status} of all VDSes (DBs), None if list failed
+        """
+        iter_pages, record = (Server.iter_pages, vds_index_record) if self.kind == 'vds' else \
+            (Dbaas.iter_pages, db_index_record)
+        servers = dict()
+        records = []
+        try:
+            with api.fresh():
+                pages = list(iter_pages())
+            for page in pages:
+                if page is None:
+                    return None
+                for i in page:
+                    servers[i['id']] = i['status']
+                    records.append(record(i))
+        except Exception:
+            return None
+        index_save(self.kind, records)
+        return servers
+
+    def run(self):
+        delay = WAIT_DELAY
+        while True:
+            with self.lock:
+                if not self.pending:
+                    self.thread = None
+                    return
+                self.fresh = False
+            polled = time()
+            servers = self.poll()
+            with self.lock:
+                for target in list(self.pending):
+                    outcome = None
+                    status = servers.get(target['id']) if servers is not None else target['result'][1]
+                    if servers is not None:
+                        if target['status'] is None and target['id'] not in servers:
+                            outcome = 'ready'
+                        elif status is not None and status == target['status']:
+                            outcome = 'ready'
+                        elif status in self.failed:
+                            outcome = 'failed'
+                    if outcome is None and time() >= target['deadline']:
+                        outcome = 'timeout'
+                    target['result'] = (outcome, status)
+                    if outcome is not None:
+                        self.pending.remove(target)
+                        target['event'].set()
+                if not self.pending:
+                    continue
+                nearest = min(i['deadline'] for i in self.pending)
+            # Sleep with jitter; new VDS to wait for cuts long delay short
+            wake = min(polled + delay / 2 + random.uniform(0, delay / 2), nearest)
+            while time() < wake:
+                if self.fresh:
+                    wake = min(wake, polled + WAIT_DELAY)
+                sleep(min(0.05, max(0, wake - time())))
+            delay = WAIT_DELAY if self.fresh else min(delay * WAIT_FACTOR, WAIT_MAX_DELAY)
+
+
+poller = Poller()
+db_poller = Poller('dbs')
+
+
+def run_dag(tasks, concurrency=BULK_CONCURRENCY):
+    """
+    Run tasks {key: (keys of tasks it depends on, request, complete)}, each one as soon as all its dependencies
+    are 'ready'. request() is run on a pool of concurrency workers and returns (outcome, detail).
+    If outcome is 'requested', complete(detail) is run outside of the pool (it mostly waits, e.g. for poller)
+    and gives (outcome, detail) of the task. Tasks with failed dependency are 'skipped'.
+    Yields (key, outcome, detail) as soon as task is done.
+    """
+    from concurrent.futures import wait, FIRST_COMPLETED
+    waiting = dict(tasks)
+    outcomes = dict()
+    running = dict()
+    # Waiting threads only sleep, one per task is fine
+    with ThreadPoolExecutor(max_workers=max(1, concurrency)) as pool, \
+            ThreadPoolExecutor(max_workers=max(1, len(tasks))) as waiters:
+        while waiting or running:
+            progress = True
+            while progress:
+                progress = False
+                for key, (after, request, complete) in list(waiting.items()):
+                    if any(outcomes.get(i, 'ready') != 'ready' for i in after):
+                        del waiting[key]
+                        outcomes[key] = 'skipped'
+                        progress = True
+                        yield key, 'skipped', None
+                    elif all(i in outcomes for i in after):
+                        del waiting[key]
+                        running[pool.submit(request)] = key, complete
+            if not running:
+                # What is left waits for itself
+                for key in waiting:
+                    yield key, 'skipped', 'dependency cycle'
+                return
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                key, complete = running.pop(future)
+                try:
+                    outcome, detail = future.result()
+                except Exception as e:
+                    outcome, detail = 'error', str(e)
+                if outcome == 'requested' and complete is not None:
+                    running[waiters.submit(complete, detail)] = key, None
+                    continue
+                outcomes[key] = outcome
+                yield key, outcome, detail
+
+
+def wait_error(outcome, state, **record):
+    """
+    Print why waiting was not successful and exit
+    """
+    if outcome == 'timeout':
+        error("Timeout", outcome=outcome, status=state, **record)
+    else:
+        error("Failed: " + str(state), outcome=outcome, status=state, **record)
+
+
+def get_ids(ids, stdin=False, kind='vds'):
+    """
+    IDs from arguments, plus whitespace separated ones from stdin if asked.
+    Arguments are IDs or selectors, see resolve().
+    """
+    args = list(ids or [])
+    if stdin:
+        args += sys.stdin.read().split()
+    ids = []
+    seen = set()
+    for arg in args:
+        for i in resolve(kind, arg):
+            if i not in seen:
+                seen.add(i)
+                ids.append(i)
+    return ids
+
+
+def get_id(arg, kind='vds'):
+    """
+    One ID from argument (ID or selector matching one VDS/DB), asked for if there is none
+    """
+    if arg is None:
+        arg = ask_vds_id() if kind == 'vds' else ask_db_id()
+    ids = resolve(kind, arg)
+    if len(ids) > 1:
+        error(str(arg) + " matches " + str(len(ids)) + ": " + ', '.join(map(str, ids)))
+    return ids[0]
+
+
+def bulk_action(vds_ids, action, status, concurrency=BULK_CONCURRENCY, wait=True, timeout=WAIT_TIMEOUT):
+    """
+    Run action (Server.start etc) for every VDS on a pool of concurrency workers,
+    then wait until VDS has status (see Poller.wait). Only requests are limited by concurrency,
+    all VDSes are waited for together with one list call per tick, so it takes as long as the slowest of them.
+    Yields (vds_id, outcome, status) as soon as VDS is done,
+    outcome is 'ready', 'requested' (no wait), 'failed', 'timeout' or 'error'
+    """
+    # Waiting threads only sleep until poller wakes them, one per VDS is fine
+    with ThreadPoolExecutor(max_workers=max(1, len(vds_ids))) as waiters:
+        waiting = dict()
+        for vds_id, result in pool_map(action, vds_ids, concurrency):
+            if isinstance(result, Exception):
+                yield vds_id, 'error', str(result)
+            elif result is None:
+                yield vds_id, 'error', None
+            elif not wait:
+                yield vds_id, 'requested', None
+            else:
+                waiting[waiters.submit(poller.wait, vds_id, status, timeout)] = vds_id
+        for future in as_completed(waiting):
+            outcome, state = future.result()
+            yield waiting[future], outcome, state
+
+
+def pool_map(func, items, concurrency=BULK_CONCURRENCY):
+    """
+    Call func(item) for every item on a pool of concurrency workers.
+    Yields (item, result) as soon as item is done, result is the exception if func raised one
+    """
+    with ThreadPoolExecutor(max_workers=max(1, concurrency)) as pool:
+        futures = {pool.submit(func, item): item for item in items}
+        for future in as_completed(futures):
+            try:
+                result = future.result()
+            except Exception as e:
+                result = e
+            yield futures[future], result
+
+
+def select_vds(vds_ids, everyone=False, name=None):
+    """
+    VDSes (records of local index) for fleet-wide commands: all of them or ones with given IDs,
+    optionally only ones with name matching shell pattern.
+    All of them are fetched with one paged list call, given ones come from index if it is fresh,
+    so disk IDs etc. need no get_vds() per VDS.
+    """
+    import fnmatch
+    wanted = set(vds_ids or [])
+    records = get_index('vds', refresh=everyone)
+    if not everyone and not wanted <= set(i['id'] for i in records):
+        records = get_index('vds', refresh=True)
+    found = set()
+    servers = []
+    for i in records:
+        if not everyone and i['id'] not in wanted:
+            continue
+        found.add(i['id'])
+        if name is None or fnmatch.fnmatchcase(i['name'], name):
+            servers.append(i)
+    missing = wanted - found
+    if missing:
+        error("No such VDS: " + ', '.join(map(str, sorted(missing))))
+    return servers
+
+
+def disk_of(vds):
+    """
+    Main disk ID of VDS from API list, None if list did not have it
+    """
+    return (vds.get('disk_stats') or {}).get('disk_id')
+
+
+class Journal:
+    """
+    Append-only log of a sweep over many VDSes, kept in cache dir.
+    If sweep is interrupted, it can be resumed with only VDSes which are not done yet.
+    First line has IDs of the whole sweep, then there is a line per done VDS.
+    """
+    def __init__(self, name):
+        self.path = cache_path(name)
+        self.file = None
+
+    def pending(self):
+        """
+        IDs of unfinished sweep which are not done yet, None if there is no such sweep
+        """
+        try:
+            with open(self.path) as journal:
+                lines = journal.read().splitlines()
+            head = json.loads(lines[0])
+            if head.get('url') != api.base_url:
+                return None
+            finished = set()
+            for line in lines[1:]:
+                try:
+                    finished.add(json.loads(line)['id'])
+                except (ValueError, KeyError):
+                    # Last line may be cut by crash
+                    pass
+            return [i for i in head['ids'] if i not in finished]
+        except (OSError, ValueError, KeyError, IndexError):
+            return None
+
+    def start(self, vds_ids):
+        os.makedirs(os.path.dirname(self.path), mode=0o700, exist_ok=True)
+        self.file = open(os.open(self.path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), 'w')
+        self.write(dict(url=api.base_url, ids=list(vds_ids), started=time()))
+
+    def resume(self):
+        self.file = open(self.path, 'a')
+
+    def write(self, record):
+        self.file.write(json.dumps(record) + '\n')
+        self.file.flush()
+
+    def done(self, vds_id, **record):
+        self.write(dict(id=vds_id, **record))
+
+    def close(self, finished=False):
+        """
+        Close journal, finished sweep is not needed anymore
+        """
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+        if finished:
+            os.remove(self.path)
+
+
+def bulk_report(results, raw=False, success=('ready', 'requested')):
+    """
+    Print results of bulk_action per VDS as they come, exit with 1 if any of them failed
+    (outcome is not in success)
+    """
+    report = dict()
+    x = Output(['id', 'outcome', 'status'])
+    for vds_id, outcome, state in results:
+        report[vds_id] = dict(outcome=outcome, status=state)
+        if raw:
+            continue
+        if settings['output'] != 'table':
+            x.add(dict(id=vds_id, outcome=outcome, status=state))
+            continue
+        if outcome in success:
+            color = typer.colors.GREEN
+        else:
+            color = typer.colors.RED
+        print(str(vds_id) + ': ' + typer.style(outcome + ('' if state is None else ' (' + str(state) + ')'), fg=color))
+    if raw:
+        print(json.dumps(report))
+    elif settings['output'] != 'table':
+        x.close()
+    if any(i['outcome'] not in success for i in report.values()):
+        sys.exit(1)
+
+
+def ask_vds_id(multi=False):
+    """
+    VDS ID was not given: pick it (or many of them with multi) from local index.
+    Lines of batch are not answers, so there it is an error.
+    """
+    if not settings['interactive']:
+        error("No VDS ID provided")
+    ids = pick('vds', multi)
+    return ids if multi else ids[0]
+
+
+def ask_db_id():
+    """
+    DB ID was not given: pick it from local index
+    """
+    if not settings['interactive']:
+        error("No DB ID provided")
+    return pick('dbs')[0]
+
+
+def fuzzy_score(query, text):
+    """
+    How well query matches text, lower is better: characters of query must be in text in this order,
+    closer to each other and to the start is better. None if it does not match.
+    """
+    if not query:
+        return 0, 0
+    best = None
+    start = text.find(query[0])
+    while start != -1:
+        end = start
+        for char in query[1:]:
+            end = text.find(char, end + 1)
+            if end == -1:
+                # Later starts will not match either
+                return best
+        if best is None or end - start < best[0]:
+            best = (end - start, start)
+        start = text.find(query[0], start + 1)
+    return best
+
+
+def pick_line(kind, record):
+    """
+    Line of picker for VDS or DB record of local index
+    """
+    if kind == 'vds':
+        keys = ('id', 'name', 'ip', 'status', 'cpus', 'ram')
+    else:
+        keys = ('id', 'name', 'ip', 'type', 'status')
+    return '  '.join(str(record.get(key)) for key in keys)
+
+
+def pick(kind, multi=False):
+    """
+    Incremental fuzzy picker over local index of VDSes or DBs: type to filter, arrows to move,
+    Tab to mark (if multi), Enter to choose, Esc to cancel. Returns list of chosen IDs.
+    Opens from cached index at once even if it is stale, fresh one is fetched in background meanwhile.
+    If stdin is not a terminal, ID or selector is read as a line instead.
+    """
+    import click
+    what = 'VDS' if kind == 'vds' else 'DB'
+    records, fresh = index_cached(kind)
+    if records is None:
+        records, fresh = get_index(kind), True
+    if not sys.stdin.isatty():
+        return pick_input(what, records, multi)
+
+    refreshed = []
+    if not fresh:
+        threading.Thread(target=lambda: refreshed.append(fetch_index(kind)), daemon=True).start()
+    lines = dict((i['id'], pick_line(kind, i)) for i in records)
+    query = ''
+    cursor = 0
+    marked = []
+    drawn = 0
+    out = sys.stderr
+    try:
+        while True:
+            if refreshed and refreshed[0] is not None:
+                lines = dict((i['id'], pick_line(kind, i)) for i in refreshed.pop())
+                marked = [i for i in marked if i in lines]
+            scored = []
+            for item_id, line in lines.items():
+                score = fuzzy_score(query.lower(), line.lower())
+                if score is not None:
+                    scored.append((score, item_id))
+            scored.sort()
+            matches = [item_id for score, item_id in scored[:PICKER_ROWS]]
+            cursor = max(0, min(cursor, len(matches) - 1))
+
+            screen = ["Pick " + what + ": " + query]
+            for n, item_id in enumerate(matches):
+                screen.append(('> ' if n == cursor else '  ') + ('* ' if item_id in marked else '  ') + lines[item_id])
+            screen.append(typer.style("{} of {}{}, Enter to choose, Esc to cancel".format(
+                len(scored), len(lines), ", Tab to mark" if multi else ''), dim=True))
+            # Draw over previous screen
+            if drawn:
+                out.write('\x1b[{}F'.format(drawn - 1) if drawn > 1 else '\r')
+            out.write('\x1b[J' + '\n'.join(screen))
+            out.flush()
+            drawn = len(screen)
+
+            key = click.getchar()
+            if key in ('\r', '\n'):
+                if marked:
+                    return marked
+                if matches:
+                    return [matches[cursor]]
+            elif key in ('\x1b[A', '\xe0H'):
+                cursor -= 1
+            elif key in ('\x1b[B', '\xe0P'):
+                cursor += 1
+            elif key == '\t' and multi and matches:
+                if matches[cursor] in marked:
+                    marked.remove(matches[cursor])
+                else:
+                    marked.append(matches[cursor])
+                cursor += 1
+            elif key in ('\x7f', '\x08'):
+                query = query[:-1]
+            elif key == '\x1b':
+                raise KeyboardInterrupt
+            elif key.isprintable():
+                query += key
+                cursor = 0
+    except (KeyboardInterrupt, EOFError):
+        pass
+    finally:
+        if drawn:
+            out.write('\x1b[{}F'.format(drawn - 1) if drawn > 1 else '\r')
+            out.write('\x1b[J')
+            out.flush()
+    error("No " + what + " ID provided")
+
+
+def pick_input(what, records, multi=False):
+    """
+    Picker without terminal: read ID or selector until it matches something in local index
+    (exactly one thing, unless multi)
+    """
+    known = set(i['id'] for i in records)
+    while True:
+        try:
+            answer = input("Enter " + what + " ID: ").strip()
+        except EOFError:
+            error("No " + what + " ID provided")
+        if answer.isdigit() and int(answer) in known:
+            return [int(answer)]
+        if answer and not answer.isdigit():
+            try:
+                check = parse_selector(answer)
+                ids = [i['id'] for i in records if check(i)]
+            except ValueError as e:
+                print(e, file=sys.stderr)
+                continue
+            if len(ids) > 1 and not multi:
+                print(answer + " matches " + str(len(ids)) + ": " + ', '.join(map(str, ids)), file=sys.stderr)
+                continue
+            if ids:
+                return ids
+        print("No such " + what + ": " + answer, file=sys.stderr)
+
+
+def completion_cache(name, ttl, refresh_args):
+    """
+    Cached data for shell completion: it must answer in milliseconds, so there is no API call and no auth here.
+    If cache is missing or stale, CLI is started in background (refresh_args) to fetch it for the next Tab.
+    """
+    data = cache_load(name + '.json')
+    if data and data.get('url', api.base_url) != api.base_url:
+        data = None
+    updated = data and (data.get('updated') or data.get('fetched_at')) or 0
+    if updated + ttl < time():
+        marker = cache_path('refresh-' + name)
+        try:
+            if os.path.getmtime(marker) + COMPLETION_REFRESH > time():
+                return data
+        except OSError:
+            pass
+        import subprocess
+        os.makedirs(os.path.dirname(marker), mode=0o700, exist_ok=True)
+        with open(marker, 'w'):
+            pass
+        # Without variables of completion, or it would complete instead of refresh
+        env = dict((key, value) for key, value in os.environ.items()
+                   if not key.endswith('_COMPLETE') and not key.startswith('_TYPER_COMPLETE'))
+        subprocess.Popen([sys.executable, os.path.abspath(__file__), '--output', 'ndjson'] + refresh_args,
+                         env=env, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                         start_new_session=True)
+    return data
+
+
+def complete_vds(incomplete: str):
+    """
+    VDS IDs and names from local index
+    """
+    data = completion_cache('index-vds', INDEX_TTL, ['vds', 'list']) or dict(items=[])
+    for i in data['items']:
+        yield str(i['id']), "{name} {status} {ip}".format(**i)
+        yield i['name'], "id {id} {status} {ip}".format(**i)
+
+
+def complete_db(incomplete: str):
+    """
+    DB IDs and names from local index
+    """
+    data = completion_cache('index-dbs', INDEX_TTL, ['dbs', 'list']) or dict(items=[])
+    for i in data['items']:
+        yield str(i['id']), "{name} {type} {status}".format(**i)
+        yield i['name'], "id {id} {type} {status}".format(**i)
+
+
+def complete_backup(ctx: typer.Context, incomplete: str):
+    """
+    Backup IDs from local index of backups, which is made by backup list.
+    Only of VDS given before, if click could parse it (it can not when the option is the last word).
+    """
+    vds_id = str(ctx.params.get('vds_id') or '')
+    refresh = ['vds', 'backup', 'list'] + ([vds_id] if vds_id.isdigit() else ['--all'])
+    data = completion_cache('index-backups', INDEX_TTL, refresh) or dict(items=[])
+    for i in data['items']:
+        if not vds_id.isdigit() or str(i['vds_id']) == vds_id:
+            yield str(i['id']), "VDS {vds_id} {c_date} {status}".format(**i)
+
+
+def complete_preset(incomplete: str):
+    data = completion_cache('presets', CATALOG_TTL, ['vds', 'info', 'plans']) or dict(data=dict(presets=[]))
+    for i in data['data']['presets']:
+        yield str(i['id']), "{name}, {description}, {discount_value}".format(**i)
+
+
+def complete_os(incomplete: str):
+    data = completion_cache('os', CATALOG_TTL, ['vds', 'info', 'os']) or dict(data=dict(os=[]))
+    for i in data['data']['os']:
+        yield str(i['id']), "{os_caption} {os_name}".format(**i)
+
+
 @snapshot_app.command("get")
-def get_snap(vds_id: Optional[int] = typer.Argument(None)):
+def get_snap(vds_id: Optional[str] = typer.Argument(None, help="VDS ID or selector", autocompletion=complete_vds)):
     """
     Get snapshot
     """
-    if vds_id is None:
-        vds_list()
-        vds_id = input("Enter VDS ID: ")
+    vds_id = get_id(vds_id)
     result = Snapshots.get(vds_id)
     if result is None:
-        print(typer.style("Error", fg=typer.colors.RED))
-        sys.exit(1)
+        error()
     else:
-        x = PrettyTable()
-        x.field_names = ["VDS ID", "ID", "Created", "Expire"]
-        x.add_row([vds_id, result['restore_point']['id'], result['restore_point']['created_at'], result['restore_point']['expired_at']])
-        print(x)
+        x = Output(['vds_id', 'id', 'created_at', 'expired_at'], headers=["VDS ID", "ID", "Created", "Expire"], one=True)
+        x.add(dict(
+            vds_id=vds_id,
+            id=result['restore_point']['id'],
+            created_at=result['restore_point']['created_at'],
+            expired_at=result['restore_point']['expired_at']
+        ))
+        x.close()
+
+
+def snap_record(vds, result):
+    """
+    Row of snapshot list, restore point fields are empty if VDS has none
+    """
+    point = (result or {}).get('restore_point') or {}
+    return dict(vds_id=vds['id'], name=vds['name'], id=point.get('id'),
+                created_at=point.get('created_at'), expired_at=point.get('expired_at'))
+
+
+@snapshot_app.command("list")
+def list_snap(vds_ids: Optional[List[str]] = typer.Argument(None, help="VDS IDs or selectors, all of them if none",
+                                                            autocompletion=complete_vds),
+              everyone: bool = typer.Option(False, "--all", help="Snapshots of every VDS"),
+              name: Optional[str] = typer.Option(None, help="Only VDSes with name matching shell pattern"),
+              stdin: bool = typer.Option(False, help="Read VDS IDs from stdin"),
+              expiring_within: Optional[float] = typer.Option(None, help="Only snapshots expiring within DAYS")):
+    """
+    List snapshots of many VDSes, sooner to expire first
+    """
+    import asyncio
+    vds_ids = get_ids(vds_ids, stdin)
+    servers = select_vds(vds_ids, everyone or not vds_ids, name)
+    border = None if expiring_within is None else time() + expiring_within * 86400
+    # Table is sorted, so it is printed at once, other formats are streamed as they come
+    stream = settings['output'] != 'table'
+    fields = ['vds_id', 'name', 'id', 'created_at', 'expired_at']
+    x = Output(fields, headers=["VDS ID", "Name", "ID", "Created", "Expire"],
+               pretty=lambda i: ['' if i[k] is None else i[k] for k in fields])
+    rows = []
+    failed = []
+
+    async def fetch(vds):
+        try:
+            return vds, await AsyncSnapshots.find(vds['id'])
+        except Exception as e:
+            return vds, e
+
+    async def collect():
+        for task in asyncio.as_completed([fetch(i) for i in servers]):
+            vds, result = await task
+            if isinstance(result, Exception):
+                failed.append(vds['id'])
+                continue
+            row = snap_record(vds, result)
+            if border is not None and (parse_date(row['expired_at']) or float('inf')) > border:
+                continue
+            if stream:
+                x.add(row)
+                x.flush()
+            else:
+                rows.append(row)
+
+    asyncio.run(collect())
+    rows.sort(key=lambda i: (parse_date(i['expired_at']) or float('inf'), i['vds_id']))
+    for row in rows:
+        x.add(row)
+    x.close()
+    if failed:
+        error("Failed for VDS: " + ', '.join(map(str, sorted(failed))), vds_ids=sorted(failed))
 
 
 @snapshot_app.command("create")
-def create_snap(vds_id: Optional[int] = typer.Argument(None)):
+def create_snap(vds_id: Optional[str] = typer.Argument(None, help="VDS ID or selector", autocompletion=complete_vds)):
     """
     Create snapshot
     """
-    if vds_id is None:
-        vds_list()
-        vds_id = input("Enter VDS ID: ")
+    vds_id = get_id(vds_id)
 
     result = Snapshots.create(vds_id)
     if result is None:
-        print(typer.style("Error", fg=typer.colors.RED))
-        sys.exit(1)
+        error(vds_id=vds_id)
     else:
-        print(typer.style("Success", fg=typer.colors.GREEN))
+        done("Success", vds_id=vds_id)
 
 
 @snapshot_app.command("restore")
-def rollback_snap(vds_id: Optional[int] = typer.Argument(None)):
+def rollback_snap(vds_id: Optional[str] = typer.Argument(None, help="VDS ID or selector", autocompletion=complete_vds)):
     """
     Restore VDS from snapshot
     """
-    if vds_id is None:
-        vds_list()
-        vds_id = input("Enter VDS ID: ")
+    vds_id = get_id(vds_id)
 
     result = Snapshots.restore(vds_id)
     if result is None:
-        print(typer.style("Error", fg=typer.colors.RED))
-        sys.exit(1)
+        error(vds_id=vds_id)
     else:
-        print(typer.style("Success", fg=typer.colors.GREEN))
+        done("Success", vds_id=vds_id)
 
 
 @snapshot_app.command("remove")
-def remove_snap(vds_id: Optional[int] = typer.Argument(None)):
+def remove_snap(vds_id: Optional[str] = typer.Argument(None, help="VDS ID or selector", autocompletion=complete_vds)):
     """
     Remove snapshot
     """
-    if vds_id is None:
-        vds_list()
-        vds_id = input("Enter VDS ID: ")
+    vds_id = get_id(vds_id)
 
     result = Snapshots.remove(vds_id)
     if result is None:
-        print(typer.style("Error", fg=typer.colors.RED))
-        sys.exit(1)
+        error(vds_id=vds_id)
     else:
-        print(typer.style("Success", fg=typer.colors.GREEN))
+        done("Success", vds_id=vds_id)
 
 
 @backups_app.command("create")
-def create_backup(vds_id: Optional[int] = typer.Argument(None)):
+def create_backup(vds_ids: Optional[List[str]] = typer.Argument(None, help="VDS IDs or selectors",
+                                                                autocompletion=complete_vds),
+                  everyone: bool = typer.Option(False, "--all", help="Backup every VDS"),
+                  name: Optional[str] = typer.Option(None, help="Only VDSes with name matching shell pattern"),
+                  stdin: bool = typer.Option(False, help="Read VDS IDs from stdin"),
+                  concurrency: int = typer.Option(BULK_CONCURRENCY, help="Max VDSes processed at once"),
+                  resume: bool = typer.Option(False, help="Continue unfinished sweep: only VDSes without backup yet"),
+                  raw: bool = typer.Option(False, help="Get result as raw json")):
     """
-    Create backup of main disk
+    Create backup of main disk (of many VDSes)
     """
-    if vds_id is None:
-        vds_list()
-        vds_id = input("Enter VDS ID: ")
+    vds_ids = get_ids(vds_ids, stdin)
+    if not (vds_ids or everyone or name is not None or resume):
+        vds_ids = ask_vds_id(multi=True)
+    if len(vds_ids) > 1 or everyone or name is not None or resume:
+        backup_sweep(vds_ids, everyone, name, concurrency, resume, raw)
+        return
+    vds_id = vds_ids[0]
     result = Backups.create(vds_id)
     if result is None:
-        print(typer.style("Error", fg=typer.colors.RED))
-        sys.exit(1)
+        error(vds_id=vds_id)
+    else:
+        done("Success", vds_id=vds_id)
+
+
+def backup_sweep(vds_ids, everyone, name, concurrency, resume, raw):
+    """
+    Backup many VDSes on a pool of workers, keeping journal of done ones
+    """
+    journal = Journal('backup-sweep.journal')
+    pending = journal.pending() if resume else None
+    if pending is not None:
+        # Servers removed since sweep started are not pending anymore
+        pending = set(pending)
+        servers = [i for i in select_vds(None, everyone=True) if i['id'] in pending]
+        journal.resume()
     else:
-        print(typer.style("Success", fg=typer.colors.GREEN))
+        if not (vds_ids or everyone or name is not None):
+            error("Nothing to resume")
+        # --name alone is a filter over all VDSes
+        servers = select_vds(vds_ids, everyone or not vds_ids, name)
+        journal.start(i['id'] for i in servers)
+
+    def worker(vds):
+        if Backups.create(vds['id'], vds['disk_id']) is None:
+            return 'error', None
+        return 'created', None
+
+    def results():
+        for vds, result in pool_map(worker, servers, concurrency):
+            outcome, state = ('error', str(result)) if isinstance(result, Exception) else result
+            if outcome == 'created':
+                journal.done(vds['id'])
+            yield vds['id'], outcome, state
+
+    # bulk_report exits if some VDS failed, then journal is kept for --resume
+    failed = True
+    try:
+        bulk_report(results(), raw, success=('created',))
+        failed = False
+    finally:
+        journal.close(finished=not failed)
+
+
+def backup_targets(vds_ids, everyone, name, stdin):
+    """
+    (vds_id, disk_id) of VDSes for fleet-wide backup commands, just one without disk_id if it is asked for
+    """
+    vds_ids = get_ids(vds_ids, stdin)
+    if not (vds_ids or everyone or name is not None):
+        vds_ids = ask_vds_id(multi=True)
+    if len(vds_ids) > 1 or everyone or name is not None:
+        # --name alone is a filter over all VDSes
+        return [(i['id'], i['disk_id']) for i in select_vds(vds_ids, everyone or not vds_ids, name)]
+    return [(vds_ids[0], None)]
+
+
+BACKUP_FIELDS = ['vds_id', 'id', 'c_date', 'drive_size', 'cost_backup', 'mounted', 'status']
+BACKUP_HEADERS = ["VDS", "id", "Date", "Size", "Cost", "Mounted", "status"]
+# Least widths of table columns printed row by row, see TableStream
+BACKUP_WIDTHS = dict(vds_id=6, id=8, c_date=19, status=8)
+
+
+@backups_app.command("list")
+def list_backup(vds_ids: Optional[List[str]] = typer.Argument(None, help="VDS IDs or selectors",
+                                                              autocompletion=complete_vds),
+                everyone: bool = typer.Option(False, "--all", help="Backups of every VDS"),
+                name: Optional[str] = typer.Option(None, help="Only VDSes with name matching shell pattern"),
+                stdin: bool = typer.Option(False, help="Read VDS IDs from stdin"),
+                concurrency: int = typer.Option(BULK_CONCURRENCY, help="Max VDSes processed at once")):
+    """
+    List backups (of many VDSes)
+    """
+    targets = backup_targets(vds_ids, everyone, name, stdin)
+    x = Output(BACKUP_FIELDS, headers=BACKUP_HEADERS, widths=BACKUP_WIDTHS)
+    failed = []
+    listed = dict()
+    for (vds_id, disk_id), result in pool_map(lambda target: Backups.list(*target), targets, concurrency):
+        if result is None or isinstance(result, Exception):
+            failed.append(vds_id)
+            continue
+        listed[vds_id] = [dict((key, i.get(key)) for key in BACKUP_FIELDS if key != 'vds_id')
+                          for i in result['backups']]
+        for i in result['backups']:
+            x.add(dict(i, vds_id=vds_id))
+        x.flush()
+    x.close()
+    # Local index of backups is only for shell completion of backup IDs
+    records, _ = index_cached('backups')
+    index_save('backups', [i for i in records or [] if i['vds_id'] not in listed] +
+               [dict(i, vds_id=vds_id) for vds_id, backups in listed.items() for i in backups])
+    if failed:
+        error("Failed for VDS: " + ', '.join(map(str, sorted(failed))), vds_ids=sorted(failed))
+
+
+def parse_date(value):
+    """
+    Timestamp of API date ("2022-03-17 10:22:01", ISO with or without Z), None if it is not a date
+    """
+    from datetime import datetime, timezone
+    try:
+        date = datetime.fromisoformat(str(value).replace('Z', '+00:00'))
+    except ValueError:
+        return None
+    if date.tzinfo is None:
+        date = date.replace(tzinfo=timezone.utc)
+    return date.timestamp()
 
 
-@backups_app.command("list")
-def list_backup(vds_id: Optional[int] = typer.Argument(None)):
+def expired_backups(backups, keep=None, older_than=None):
     """
-    List backups
+    Backups to remove by retention: not one of keep newest ones and older than older_than days
     """
-    if vds_id is None:
-        vds_list()
-        vds_id = input("Enter VDS ID: ")
-    result = Backups.list(vds_id)
-    if result is None:
-        print(typer.style("Error", fg=typer.colors.RED))
-        sys.exit(1)
+    backups = sorted(backups, key=lambda i: parse_date(i.get('c_date')) or 0, reverse=True)
+    if keep is not None:
+        backups = backups[keep:]
+    if older_than is not None:
+        border = time() - older_than * 86400
+        backups = [i for i in backups if (parse_date(i.get('c_date')) or 0) < border]
+    return backups
+
+
+@backups_app.command("prune")
+def prune_backup(vds_ids: Optional[List[str]] = typer.Argument(None, help="VDS IDs or selectors",
+                                                               autocompletion=complete_vds),
+                 everyone: bool = typer.Option(False, "--all", help="Backups of every VDS"),
+                 name: Optional[str] = typer.Option(None, help="Only VDSes with name matching shell pattern"),
+                 stdin: bool = typer.Option(False, help="Read VDS IDs from stdin"),
+                 keep: Optional[int] = typer.Option(None, min=0, help="Keep this many newest backups of every VDS"),
+                 older_than: Optional[float] = typer.Option(None, help="Remove only backups older than DAYS"),
+                 dry_run: bool = typer.Option(False, help="Only show what would be removed"),
+                 concurrency: int = typer.Option(BULK_CONCURRENCY, help="Max requests at once")):
+    """
+    Remove old backups by retention policy (of many VDSes)
+    """
+    if keep is None and older_than is None:
+        error("Give --keep and/or --older-than")
+    targets = backup_targets(vds_ids, everyone, name, stdin)
+    victims = []
+    failed = []
+    for (vds_id, disk_id), result in pool_map(lambda target: Backups.list(*target), targets, concurrency):
+        if result is None or isinstance(result, Exception):
+            failed.append(vds_id)
+            continue
+        for i in expired_backups(result['backups'], keep, older_than):
+            victims.append((vds_id, disk_id, i['id'], i.get('c_date')))
+
+    x = Output(['vds_id', 'id', 'c_date', 'outcome'], headers=["VDS", "id", "Date", "outcome"],
+               widths=dict(BACKUP_WIDTHS, outcome=12))
+    if dry_run:
+        for vds_id, disk_id, backup_id, date in victims:
+            x.add(dict(vds_id=vds_id, id=backup_id, c_date=date, outcome='would remove'))
+        x.close()
     else:
-        x = PrettyTable()
-        x.field_names = ["id", "Date", "Size", "Cost", "Mounted", "status"]
-        for i in result['backups']:
-            x.add_row([i['id'], i['c_date'], i['drive_size'], i['cost_backup'], i['mounted'], i['status']])
-        print(x)
+        def worker(victim):
+            vds_id, disk_id, backup_id, date = victim
+            return Backups.remove(vds_id, backup_id, disk_id)
+
+        for (vds_id, disk_id, backup_id, date), result in pool_map(worker, victims, concurrency):
+            if result is None or isinstance(result, Exception):
+                failed.append(vds_id)
+                outcome = 'error'
+            else:
+                outcome = 'removed'
+            x.add(dict(vds_id=vds_id, id=backup_id, c_date=date, outcome=outcome))
+            x.flush()
+        x.close()
+    if failed:
+        error("Failed for VDS: " + ', '.join(map(str, sorted(set(failed)))), vds_ids=sorted(set(failed)))
 
 
 @backups_app.command("remove")
-def remove_backup(vds_id: Optional[int] = typer.Argument(None), backup_id: int = typer.Option(...)):
+def remove_backup(vds_id: Optional[str] = typer.Argument(None, help="VDS ID or selector",
+                                                         autocompletion=complete_vds),
+                  backup_id: int = typer.Option(..., autocompletion=complete_backup)):
     """
     Remove backup of main disk
     """
-    if vds_id is None:
-        vds_list()
-        vds_id = input("Enter VDS ID: ")
+    vds_id = get_id(vds_id)
     result = Backups.remove(vds_id, backup_id)
     if result is None:
-        print(typer.style("Error", fg=typer.colors.RED))
-        sys.exit(1)
+        error(vds_id=vds_id, backup_id=backup_id)
     else:
-        print(typer.style("Success", fg=typer.colors.GREEN))
+        done("Success", vds_id=vds_id, backup_id=backup_id)
 
 
 @app.command("balance")
@@ -397,23 +2013,96 @@ def get_balance():
     """
     Show balance and Monthly costs
     """
-    response = requests.get("https://public-api.timeweb.com/api/v1/accounts/finances", headers=reqHeader)
+    response = api.get("/api/v1/accounts/finances")
     if not response.ok:
-        print(typer.style("Error", fg=typer.colors.RED))
-        sys.exit(1)
+        error()
     else:
-        x = PrettyTable()
-        x.field_names = ["Balance", "Monthly cost"]
-        response = response.json()
-        x.add_row([response['finances']['balance'], response['finances']['monthly_cost']])
-        print(x)
+        x = Output(['balance', 'monthly_cost'], headers=["Balance", "Monthly cost"], one=True)
+        x.add(response.json()['finances'])
+        x.close()
+
+
+def name_prefix(name):
+    """
+    Name without trailing number: web-01 and web-02 are both web
+    """
+    import re
+    return re.sub(r'[-_.]*\d+$', '', name) or name
+
+
+@app.command("cost")
+def get_cost(by: str = typer.Option('server', help="Rows by server/prefix/preset"),
+             sort_by: str = typer.Option('cost', help="sort rows by cost/name"),
+             summary: bool = typer.Option(False, help="Show only total, balance and runway"),
+             refresh: bool = typer.Option(False, help="Ignore local index and cache")):
+    """
+    Monthly cost of VDSes by server, name prefix or preset, and for how long balance is enough.
+    Servers come from local index, prices from cached presets catalog,
+    so API calls do not depend on number of servers.
+    """
+    if by not in ('server', 'prefix', 'preset'):
+        error("No such grouping: " + by)
+    if sort_by not in ('cost', 'name'):
+        error("No such sort: " + sort_by)
+    catalog = get_catalog('presets', refresh=refresh)
+    if catalog is None:
+        error()
+    by_id = dict((i['id'], i) for i in catalog['presets'])
+    by_configuration = dict(((i['cpu'], i['ram'], i['drive']), i) for i in catalog['presets'])
+
+    rows = dict()
+    servers = total = unknown = 0
+    for vds in get_index('vds', refresh=refresh):
+        servers += 1
+        preset = by_id.get(vds.get('preset_id')) or by_configuration.get((vds['cpus'], vds['ram'], vds['disk']))
+        cost = preset['discount_value'] if preset else None
+        if cost is None:
+            unknown += 1
+        else:
+            total += cost
+        if by == 'server':
+            rows[vds['id']] = dict(id=vds['id'], name=vds['name'], preset=preset['name'] if preset else None,
+                                   cpus=vds['cpus'], ram=vds['ram'], disk=vds['disk'], cost=cost)
+            continue
+        name = name_prefix(vds['name']) if by == 'prefix' else (preset['name'] if preset else None)
+        row = rows.setdefault(name, dict(name=name, servers=0, cost=0))
+        row['servers'] += 1
+        row['cost'] += cost or 0
+
+    if not summary:
+        if by == 'server':
+            x = Output(['id', 'name', 'preset', 'cpus', 'ram', 'disk', 'cost'])
+        else:
+            x = Output(['name', 'servers', 'cost', 'share'], headers=[by, 'servers', 'cost', '%'])
+        key = (lambda i: (-(i['cost'] or 0), str(i['name']))) if sort_by == 'cost' else (lambda i: str(i['name']))
+        for row in sorted(rows.values(), key=key):
+            if by != 'server':
+                row['share'] = round(100 * row['cost'] / total, 1) if total else None
+            x.add(row)
+        x.close()
+        if settings['output'] != 'table':
+            return
+
+    response = api.get("/api/v1/accounts/finances")
+    if not response.ok:
+        error()
+    finances = response.json()['finances']
+    monthly = finances.get('monthly_cost') or total
+    runway = round(finances['balance'] / monthly * 30, 1) if monthly else None
+    x = Output(['servers', 'total', 'unknown', 'balance', 'monthly_cost', 'runway_days'],
+               headers=['VDSes', 'VDS cost', 'No price', 'Balance', 'Monthly cost', 'Runway, days'], one=True)
+    x.add(dict(servers=servers, total=total, unknown=unknown, balance=finances['balance'], monthly_cost=finances.get('monthly_cost'),
+               runway_days=runway))
+    x.close()
 
 
 @dbs_app.command("create")
 def dbs_create(passwd: str = typer.Option(..., help="DB password"),
                name: str = typer.Option(..., help="DB Name"),
                db_type: str = typer.Option(..., help="mysql5/mysql/postgres"),
-               raw: bool = typer.Option(False, help="Get result as raw json")):
+               raw: bool = typer.Option(False, help="Get result as raw json"),
+               wait: bool = typer.Option(True, help="Wait until DB is started"),
+               timeout: int = typer.Option(WAIT_TIMEOUT, help="Max seconds to wait")):
     """
     Create database
     """
@@ -421,18 +2110,19 @@ def dbs_create(passwd: str = typer.Option(..., help="DB password"),
     # service_type == 357 - pgsql
     result = Dbaas.create(passwd=passwd, name=name, db_type=db_type)
     if raw:
-        print(result)
+        print(json.dumps(result))
         return
+    if result is None:
+        error(name=name)
     # We need to get id from result['db']['id']
     db_id = result['db']['id']
-    for frame in cycle(r'-\|/'):
-        state = Dbaas.get(db_id)
-        if state:
-            if state['db']['status'] == 'started':
-                print(typer.style("\nCreated DB: " + name, fg=typer.colors.GREEN))
-                break
-        print('\r', frame, sep='', end='', flush=True)
-        sleep(0.1)
+    if not wait:
+        done("Creating DB: " + name + ", id " + str(db_id), id=db_id, name=name, status=result['db'].get('status'))
+        return
+    outcome, state = wait_db(db_id, timeout=timeout)
+    if outcome != 'ready':
+        wait_error(outcome, state and state['db']['status'], id=db_id, name=name)
+    done("Created DB: " + name, id=db_id, name=name, status='started')
 
 
 @dbs_app.command("list")
@@ -441,20 +2131,15 @@ def dbs_list(raw: bool = typer.Option(False, help="Get result as raw json")):
     Show list of DBs:
     ID, State, Name, IP, local IP, Password, Type
     """
-    list_of_dbaas = Dbaas.list()
     if raw:
-        print(list_of_dbaas)
+        print(json.dumps(Dbaas.list()))
         return
-    x = PrettyTable()
-    x.field_names = ['id', 'state', 'name', 'ip', 'local_ip', 'password', 'type']
-    if list_of_dbaas is None:
-        print(typer.style("Error", fg=typer.colors.RED))
-        sys.exit(1)
-    for i in list_of_dbaas['dbs']:
+
+    def pretty(i):
         if i['status'] == 'started':
             state = typer.style("Running", fg=typer.colors.GREEN)
-#        elif i['status'] == 'off':
-        #    state = typer.style('Stopped', fg=typer.colors.RED)
+        # elif i['status'] == 'off':
+        #     state = typer.style('Stopped', fg=typer.colors.RED)
         else:
             state = i['status']
         if i['type'] == 'mysql':
@@ -465,7 +2150,7 @@ def dbs_list(raw: bool = typer.Option(False, help="Get result as raw json")):
             type_of_db = 'PostgreSQL 13'
         else:
             type_of_db = i['type']
-        x.add_row([
+        return [
             i['id'],
             state,
             i['name'],
@@ -473,373 +2158,1259 @@ def dbs_list(raw: bool = typer.Option(False, help="Get result as raw json")):
             i['local_ip'],
             i['password'],
             type_of_db
-        ])
-    print(x)
+        ]
+
+    x = Output(['id', 'status', 'name', 'ip', 'local_ip', 'password', 'type'],
+               headers=['id', 'state', 'name', 'ip', 'local_ip', 'password', 'type'], pretty=pretty,
+               widths=dict(id=6, name=20, ip=15, local_ip=15))
+    records = []
+    for page in Dbaas.iter_pages():
+        if page is None:
+            error()
+        for i in page:
+            x.add(dict((key, i[key]) for key in x.fields))
+            records.append(db_index_record(i))
+        x.flush()
+    x.close()
+    index_save('dbs', records)
 
 
 @dbs_app.command("goto")
-def dbs_connect(db_id: Optional[int] = typer.Argument(None)):
+def dbs_connect(db_id: Optional[str] = typer.Argument(None, help="DB ID or selector", autocompletion=complete_db)):
     """
     Connect to DB CLI
     """
-    cmd_mysql = "mysql -u {login} -p{password} -h {ip} -P 3306 -D default_db"
-    cmd_psql = "psql -d default_db -U  {login} -W -p 5432 -h {ip}"
+    import subprocess
     # Get DB ID if not specified
-    if db_id is None:
-        dbs_list()
-        db_id = input("Enter DB ID: ")
+    db_id = get_id(db_id, 'dbs')
     # Get type of DB, password, IP
     db_data = Dbaas.get(db_id)
+    if db_data is None:
+        error(id=db_id)
+    command = db_client(db_data['db'])
+    if command is None:
+        error("Unknown DB type: " + str(db_data['db']['type']))
+    subprocess.call(command[0], env=command[1])
+
+
+def db_client(db, interactive=True):
+    """
+    (argv, env) of mysql or psql for DB, None if type is unknown.
+    Password is passed in environment, not in argv where everybody can see it.
+    """
+    env = dict(os.environ)
+    if db['type'] in ('mysql', 'mysql5'):
+        env['MYSQL_PWD'] = db['password']
+        argv = ['mysql', '-u', db['login'], '-h', db['ip'], '-P', '3306', '-D', 'default_db']
+        if not interactive:
+            argv.append('--batch')
+    elif db['type'] == 'postgres':
+        env['PGPASSWORD'] = db['password']
+        argv = ['psql', '-d', 'default_db', '-U', db['login'], '-p', '5432', '-h', db['ip']]
+        if not interactive:
+            argv += ['--no-password', '--no-psqlrc', '-v', 'ON_ERROR_STOP=1', '-f', '-']
+    else:
+        return None
+    return argv, env
 
-    db_type = db_data['db']['type']
-    db_pass = db_data['db']['password']
-    db_ip = db_data['db']['ip']
-    db_user = db_data['db']['login']
-    if db_type == 'mysql' or db_type == 'mysql5':
-        os.system(cmd_mysql.format(ip=db_ip, password=db_pass, login=db_user))
-    elif db_type == 'postgres':
-        print("Password: ", db_pass)
-        os.system(cmd_psql.format(ip=db_ip, login=db_user))
+
+def db_exec(db, sql, timeout):
+    """
+    Run SQL on DB with mysql/psql, returns record with exit code, output and time
+    """
+    import subprocess
+    record = dict(id=db['id'], name=db['name'], type=db['type'])
+    command = db_client(db, interactive=False)
+    if command is None:
+        return dict(record, exit_code=None, seconds=0, output='', error="Unknown DB type")
+    start = perf_counter()
+    try:
+        result = subprocess.run(command[0], env=command[1], input=sql, capture_output=True, text=True,
+                                timeout=timeout)
+        exit_code, output, errors = result.returncode, result.stdout, result.stderr
+    except FileNotFoundError:
+        exit_code, output, errors = None, '', command[0][0] + " is not installed"
+    except subprocess.TimeoutExpired:
+        exit_code, output, errors = None, '', "Timeout"
+    return dict(record, exit_code=exit_code, seconds=round(perf_counter() - start, 3),
+                output=output.strip(), error=errors.strip())
+
+
+@dbs_app.command("exec")
+def dbs_exec(db_ids: Optional[List[str]] = typer.Argument(None, help="DB IDs or selectors", autocompletion=complete_db),
+             everyone: bool = typer.Option(False, "--all", help="Run on every DB"),
+             file: Optional[typer.FileText] = typer.Option(None, "--file", "-f", help="SQL file, - is stdin"),
+             execute: Optional[str] = typer.Option(None, "--execute", "-e", help="SQL statement"),
+             concurrency: int = typer.Option(BULK_CONCURRENCY, help="Max DBs processed at once"),
+             timeout: int = typer.Option(WAIT_TIMEOUT, help="Max seconds for every DB")):
+    """
+    Run SQL on many DBs in parallel with mysql/psql clients, result of every DB is printed as soon as it is done
+    """
+    if (file is None) == (execute is None):
+        error("Give SQL with either --file or --execute")
+    sql = file.read() if file is not None else execute
+    wanted = None if everyone else set(get_ids(db_ids, kind='dbs'))
+    if not everyone and not wanted:
+        wanted = {ask_db_id()}
+    # Connection info (with passwords, which are not kept in index) of all DBs from one list
+    dbs = []
+    for page in Dbaas.iter_pages():
+        if page is None:
+            error()
+        dbs += [i for i in page if wanted is None or i['id'] in wanted]
+    missing = (wanted or set()) - set(i['id'] for i in dbs)
+    if missing:
+        error("No such DB: " + ', '.join(map(str, sorted(missing))))
+
+    x = Output(['id', 'name', 'type', 'exit_code', 'seconds', 'output', 'error'])
+    failed = False
+    for db, record in pool_map(lambda db: db_exec(db, sql, timeout), dbs, concurrency):
+        if isinstance(record, Exception):
+            record = dict(id=db['id'], name=db['name'], type=db['type'], exit_code=None, seconds=None,
+                          output='', error=str(record))
+        failed = failed or record['exit_code'] != 0
+        x.add(record)
+        # Output of SQL is not to be cut to fit table, so table is printed at the end
+        if settings['output'] != 'table':
+            x.flush()
+    x.close()
+    if failed:
+        sys.exit(1)
 
 
 @vds_info_app.command("plans")
 def vds_plans(raw: bool = typer.Option(False, help="Get result as raw json"),
-              sort_by: str = typer.Option(None, help="sort results by value/cpu/ram/disk")):
-    uri = "https://public-api.timeweb.com/api/v1/presets"
-    result = requests.get(uri, headers=reqHeader)
+              sort_by: str = typer.Option(None, help="sort results by value/cpu/ram/disk"),
+              refresh: bool = typer.Option(False, help="Ignore local cache")):
+    result = get_catalog('presets', refresh=refresh)
 
-    if not result.ok:
-        print('Error')
-        sys.exit(1)
+    if result is None:
+        error()
     # If raw - print raw result and exit
     if raw:
-        print(result.text)
+        print(json.dumps(result))
         sys.exit(0)
 
     # else print pretty
-    x = PrettyTable()
-    x.field_names = ['id', 'cpus', 'ram', 'disk', 'value', 'name', 'description']
-    result = result.json()
-    print("Total: "+ str(result['meta']['total']))
-    # result = result
-    for i in result['presets']:
-        x.add_row([
-            i['id'],
-            i['cpu'],
-            i['ram'],
-            i['drive'],
-            i['discount_value'],
-            i['name'],
-            i['description']
-        ])
-        if sort_by in ('cpus', 'ram', 'disk', 'value'):
-            x.sortby = sort_by
-        elif not sort_by is None:
-            print("No such sort")
-    print(x)
+    fields = ['id', 'cpu', 'ram', 'drive', 'discount_value', 'name', 'description']
+    headers = ['id', 'cpus', 'ram', 'disk', 'value', 'name', 'description']
+    presets = result['presets']
+    if sort_by in ('cpus', 'ram', 'disk', 'value'):
+        key = fields[headers.index(sort_by)]
+        presets = sorted(presets, key=lambda i: i[key])
+    elif not sort_by is None:
+        print("No such sort", file=sys.stderr)
+    if settings['output'] == 'table':
+        print("Total: "+ str(result['meta']['total']))
+    x = Output(fields, headers=headers)
+    for i in presets:
+        x.add(dict((key, i[key]) for key in fields))
+    x.close()
 
 
 @vds_info_app.command("os")
-def vds_oses(raw: bool = typer.Option(False, help="Get result as raw json")):
-    uri = "https://public-api.timeweb.com/api/v1/os"
-    result = requests.get(uri, headers=reqHeader)
+def vds_oses(raw: bool = typer.Option(False, help="Get result as raw json"),
+             refresh: bool = typer.Option(False, help="Ignore local cache")):
+    result = get_catalog('os', refresh=refresh)
 
-    if not result.ok:
-        print('Error')
-        sys.exit(1)
+    if result is None:
+        error()
     # If raw - print raw result and exit
     if raw:
-        print(result.text)
+        print(json.dumps(result))
         sys.exit(0)
 
     # else print pretty
-    x = PrettyTable()
-    x.field_names = ['id', 'fullname', 'family', 'name', 'latin', 'available']
-    result = result.json()
-    print("Total: "+ str(result['meta']['total']))
-    # result = result
+    fields = ['id', 'os_caption', 'os_type', 'os_name', 'os_latin', 'is_public']
+    if settings['output'] == 'table':
+        print("Total: "+ str(result['meta']['total']))
+    x = Output(fields, headers=['id', 'fullname', 'family', 'name', 'latin', 'available'])
     for i in result['os']:
-        x.add_row([
-            i['id'],
-            i['os_caption'],
-            i['os_type'],
-            i['os_name'],
-            i['os_latin'],
-            i['is_public']
-        ])
-    print(x)
+        x.add(dict((key, i[key]) for key in fields))
+    x.close()
 
 
 @servers_app.command("create")
 def vds_create(
         name: str = typer.Option(..., help="VDS Name"),
-        os_id: int = typer.Option(..., help="OS ID"),
-        preset: int = typer.Option(17, help="Preset ID"),
-        comment: str = typer.Option("", help="Comment")
+        os_id: int = typer.Option(..., help="OS ID", autocompletion=complete_os),
+        preset: int = typer.Option(17, help="Preset ID", autocompletion=complete_preset),
+        comment: str = typer.Option("", help="Comment"),
+        wait: bool = typer.Option(True, help="Wait until VDS is running"),
+        timeout: int = typer.Option(WAIT_TIMEOUT, help="Max seconds to wait")
 ):
-    # get user group
-    group_uri = "https://public-api.timeweb.com/api/v1/accounts/{user}/group"
-    # get username from saved base64
-    config = configparser.ConfigParser()
-    config.read(os.path.join(os.getenv('HOME'), '.config', 'twvdscli.ini'))
-    based = config.get('api', 'key', fallback=None)
-    based = base64.b64decode(based)
-    based = str(based, 'utf-8')
-    user = based.split(':')[0]
-
-    group_id = requests.get(
-        group_uri.format(user=user), headers=reqHeader
-    )
-    # finally get group id
-    if group_id.ok:
-        group_id = group_id.json()['groups'][0]['id']
-
-    data = {
-      "server": {
-        "configuration": {
-          "caption": name,
-          # "disk_size": 5, # dont give a fuck
-          # "network_bandwidth": 100, # dont give a fuck
-          "os": os_id, # 47 - ubuntu 18.04
-          # "xen_cpu": 2, # dont give a fuck
-          # "xen_ram": 4096, # dont give a fuck
-          "ddos_guard": False
-        },
-        "comment": comment,
-        "group_id": group_id, # https://public-api.timeweb.com/api/v1/accounts/{user}/group
-        "name": "string", # what is this for?
-        "preset_id": preset, # you can not create vds without this, but how to create flexible vds? (preset example: 20)
-        "install_ssh_key": "",
-        "server_id": None,
-        "local_networks": []
-        }
-    }
-
-    response = requests.post(
-        "https://public-api.timeweb.com/api/v1/vds",
-        headers=reqHeader,
-        json=data
-    )
-
-    if not response.ok:
-        print(typer.style("Error", fg=typer.colors.RED))
-        sys.exit(1)
-    else:
-        response = response.json()
-    for frame in cycle(r'-\|/'):
-        state = Server.get_vds(response['server']['id'])
-        if state:
-            if state['server']['status'] == 'on':
-                print(typer.style("\nCreated: " + response['server']['configuration']['caption'], fg=typer.colors.GREEN))
-                break
-        print('\r', frame, sep='', end='', flush=True)
-        sleep(0.1)
+    # check ids against cached catalogs, if we have them
+    for catalog, value, what in (('presets', preset, 'preset'), ('os', os_id, 'OS')):
+        ids = catalog_ids(catalog)
+        if ids is not None and value not in ids:
+            error("No such " + what + ": " + str(value))
+
+    # get user group (cached between runs)
+    group_id = get_account().get('group_id')
+
+    response = Server.create(name, os_id, preset, comment, group_id)
+    if response is None:
+        error(name=name)
+    vds_id = response['server']['id']
+    caption = response['server']['configuration']['caption']
+    if not wait:
+        done("Creating: " + caption + ", id " + str(vds_id), id=vds_id, name=caption,
+             status=response['server'].get('status'))
+        return
+    outcome, state = wait_vds(vds_id, 'on', timeout=timeout)
+    if outcome != 'ready':
+        wait_error(outcome, vds_status(state), id=vds_id, name=caption)
+    done("Created: " + caption, id=vds_id, name=caption, status='on')
 
 
 @servers_app.command("goto")
-def vds_goto(vds_id: Optional[int] = typer.Argument(None),
+def vds_goto(vds_id: Optional[str] = typer.Argument(None, help="VDS ID or selector", autocompletion=complete_vds),
              port: int = typer.Option(22, help="Specify non standart SSH port.")):
     """
     Connect via SSH to VDS
     """
-    if vds_id is None:
-        vds_list()
-        vds_id = input("Enter VDS ID: ")
+    import subprocess
+    vds_id = get_id(vds_id)
+    ip = next((i['ip'] for i in get_index('vds') if i['id'] == vds_id), None)
+    if ip is None:
+        vds = Server.get_vds(vds_id)
+        if vds is None:
+            error(id=vds_id)
+        ip = vds['server']['ip']
+
+    subprocess.call(['ssh'] + ssh_options(port) + ['root@' + ip])
+
+
+def ssh_options(port, accept_new=False):
+    """
+    ssh options sharing one master connection per host between runs (ControlMaster),
+    so the next goto or exec does not pay for SSH handshake again
+    """
+    os.makedirs(cache_path(''), mode=0o700, exist_ok=True)
+    options = ['-p', str(port),
+               '-o', 'ControlMaster=auto',
+               '-o', 'ControlPath=' + cache_path('ssh-%C'),
+               '-o', 'ControlPersist=' + SSH_PERSIST]
+    if accept_new:
+        options += ['-o', 'StrictHostKeyChecking=accept-new']
+    return options
 
-    vds = Server.get_vds(vds_id)
-    ip = vds['server']['ip']
 
-    os.system('ssh -p {port} root@{ip}'.format(port=port, ip=ip))
+def ssh_exec(vds, command, port, user, accept_new, timeout, emit):
+    """
+    Run command on VDS via ssh, emit(vds, stream, line) for every line of its output as soon as it comes.
+    Returns (exit code, seconds), exit code is None if ssh could not be run or timed out.
+    """
+    import shlex
+    import subprocess
+    if not vds['ip']:
+        emit(vds, 'stderr', "No IP")
+        return None, 0
+    # Remote shell splits the command again: arguments are quoted to reach it as they were typed,
+    # a single argument is a shell snippet as is (vds exec -- 'grep ERROR /var/log/syslog | wc -l')
+    remote = command[0] if len(command) == 1 else shlex.join(command)
+    argv = ['ssh'] + ssh_options(port, accept_new) + \
+        ['-o', 'BatchMode=yes', '-o', 'ConnectTimeout=' + str(SSH_CONNECT_TIMEOUT), user + '@' + vds['ip'], '--', remote]
+    start = perf_counter()
+    try:
+        process = subprocess.Popen(argv, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE,
+                                   stderr=subprocess.PIPE, text=True, errors='replace')
+    except FileNotFoundError:
+        emit(vds, 'stderr', "ssh is not installed")
+        return None, 0
+
+    def read(pipe, stream):
+        for line in pipe:
+            emit(vds, stream, line.rstrip('\n'))
+
+    readers = [threading.Thread(target=read, args=(process.stdout, 'stdout')),
+               threading.Thread(target=read, args=(process.stderr, 'stderr'))]
+    for reader in readers:
+        reader.start()
+    try:
+        exit_code = process.wait(timeout=timeout)
+    except subprocess.TimeoutExpired:
+        process.kill()
+        process.wait()
+        emit(vds, 'stderr', "Timeout")
+        exit_code = None
+    for reader in readers:
+        reader.join()
+    return exit_code, round(perf_counter() - start, 3)
+
+
+@servers_app.command("exec")
+def vds_exec(command: List[str] = typer.Argument(..., help="Command, after --"),
+             selector: Optional[List[str]] = typer.Option(None, "--selector", "-s",
+                                                          help="VDS ID or selector, may be given many times",
+                                                          autocompletion=complete_vds),
+             everyone: bool = typer.Option(False, "--all", help="Run on every VDS"),
+             user: str = typer.Option('root', help="SSH user"),
+             port: int = typer.Option(22, help="SSH port"),
+             accept_new: bool = typer.Option(False, help="Trust host keys of VDSes seen first time"),
+             concurrency: int = typer.Option(BULK_CONCURRENCY, help="Max VDSes processed at once"),
+             timeout: int = typer.Option(WAIT_TIMEOUT, help="Max seconds for every VDS")):
+    """
+    Run command via SSH on many VDSes in parallel: vds exec --all -- uptime.
+    Output lines are prefixed with VDS name, exit code of every VDS is printed at the end of it.
+    """
+    vds_ids = get_ids(selector)
+    if not vds_ids and not everyone:
+        vds_ids = ask_vds_id(multi=True)
+    servers = select_vds(vds_ids, everyone)
+    table = settings['output'] == 'table'
+    x = Output(['id', 'name', 'stream', 'line', 'exit_code', 'seconds'])
+    lock = threading.Lock()
+    width = max([len(i['name']) for i in servers] or [0])
+
+    def emit(vds, stream, line):
+        with lock:
+            if not table:
+                x.add(dict(id=vds['id'], name=vds['name'], stream=stream, line=line))
+            elif stream == 'stdout':
+                print(typer.style(vds['name'].ljust(width), fg=typer.colors.CYAN) + ' | ' + line, flush=True)
+            else:
+                print(typer.style(vds['name'].ljust(width), fg=typer.colors.YELLOW) + ' | ' + line,
+                      file=sys.stderr, flush=True)
+
+    failed = False
+    for vds, result in pool_map(lambda vds: ssh_exec(vds, command, port, user, accept_new, timeout, emit),
+                                servers, concurrency):
+        if isinstance(result, Exception):
+            emit(vds, 'stderr', str(result))
+            result = None, None
+        exit_code, seconds = result
+        failed = failed or exit_code != 0
+        with lock:
+            if table:
+                color = typer.colors.GREEN if exit_code == 0 else typer.colors.RED
+                print(typer.style(vds['name'].ljust(width), fg=color) + ' | ' +
+                      typer.style("exit {} in {} s".format(exit_code, seconds), fg=color), flush=True)
+            else:
+                x.add(dict(id=vds['id'], name=vds['name'], exit_code=exit_code, seconds=seconds))
+    if not table:
+        x.close()
+    if failed:
+        sys.exit(1)
 
 
 @servers_app.command("start")
-def vds_start(vds_id: Optional[int] = typer.Argument(None), raw: bool = typer.Option(False, help="Get result as raw json")):
+def vds_start(vds_ids: Optional[List[str]] = typer.Argument(None, help="VDS IDs or selectors",
+                                                            autocompletion=complete_vds),
+              raw: bool = typer.Option(False, help="Get result as raw json"),
+              wait: bool = typer.Option(True, help="Wait until VDS is running"),
+              timeout: int = typer.Option(WAIT_TIMEOUT, help="Max seconds to wait"),
+              stdin: bool = typer.Option(False, help="Read VDS IDs from stdin"),
+              concurrency: int = typer.Option(BULK_CONCURRENCY, help="Max VDSes processed at once")):
     """
-    Start VDS
+    Start VDS (or many of them)
     """
-    if vds_id is None:
-        if raw:
-            print(
-                dict(
-                    error="No VDS ID provided"
-                )
+    vds_ids = get_ids(vds_ids, stdin)
+    if not vds_ids and not raw:
+        vds_ids = ask_vds_id(multi=True)
+    if len(vds_ids) > 1:
+        bulk_report(bulk_action(vds_ids, Server.start, 'on', concurrency, wait, timeout), raw)
+        return
+    if not vds_ids:
+        print(json.dumps(
+            dict(
+                error="No VDS ID provided"
             )
-            return 1
-        vds_list()
-        vds_id = input("Enter VDS ID: ")
+        ))
+        return 1
+    vds_id = vds_ids[0]
     result = Server.start(vds_id)
     if result is None:
-        print(typer.style("Error", fg=typer.colors.RED))
-        sys.exit(1)
+        error(id=vds_id)
     if raw:
-        print(result)
+        print(json.dumps(result))
         return
-    for frame in cycle(r'-\|/'):
-        state = Server.get_vds(vds_id)
-        if state:
-            if state['server']['status'] == 'on':
-                print(typer.style("\nRunning", fg=typer.colors.GREEN))
-                break
-        print('\r', frame, sep='', end='', flush=True)
-        sleep(0.1)
+    if not wait:
+        done("Starting", typer.colors.GREEN, id=vds_id, outcome='requested')
+        return
+    outcome, state = wait_vds(vds_id, 'on', timeout=timeout)
+    if outcome != 'ready':
+        wait_error(outcome, vds_status(state), id=vds_id)
+    done("Running", typer.colors.GREEN, id=vds_id, outcome=outcome, status='on')
 
 
 @servers_app.command("stop")
-def vds_stop(vds_id: Optional[int] = typer.Argument(None), raw: bool = typer.Option(False, help="Get result as raw json")):
+def vds_stop(vds_ids: Optional[List[str]] = typer.Argument(None, help="VDS IDs or selectors",
+                                                           autocompletion=complete_vds),
+             raw: bool = typer.Option(False, help="Get result as raw json"),
+             wait: bool = typer.Option(True, help="Wait until VDS is stopped"),
+             timeout: int = typer.Option(WAIT_TIMEOUT, help="Max seconds to wait"),
+             stdin: bool = typer.Option(False, help="Read VDS IDs from stdin"),
+             concurrency: int = typer.Option(BULK_CONCURRENCY, help="Max VDSes processed at once")):
     """
-    Stop VDS
+    Stop VDS (or many of them)
     """
-    if vds_id is None:
-        if raw:
-            print(
-                dict(
-                    error="No VDS ID provided"
-                )
+    vds_ids = get_ids(vds_ids, stdin)
+    if not vds_ids and not raw:
+        vds_ids = ask_vds_id(multi=True)
+    if len(vds_ids) > 1:
+        bulk_report(bulk_action(vds_ids, Server.stop, 'off', concurrency, wait, timeout), raw)
+        return
+    if not vds_ids:
+        print(json.dumps(
+            dict(
+                error="No VDS ID provided"
             )
-            return 1
-        vds_list()
-        vds_id = input("Enter VDS ID: ")
+        ))
+        return 1
+    vds_id = vds_ids[0]
     result = Server.stop(vds_id)
     if result is None:
-        print(typer.style("Error", fg=typer.colors.RED))
-        sys.exit(1)
+        error(id=vds_id)
     if raw:
-        print(result)
-    for frame in cycle(r'-\|/'):
-        state = Server.get_vds(vds_id)
-        if state:
-            if state['server']['status'] == 'off':
-                print(typer.style("\nStopped", fg=typer.colors.RED))
-                break
-        print('\r', frame, sep='', end='', flush=True)
-        sleep(0.1)
+        print(json.dumps(result))
+        return
+    if not wait:
+        done("Stopping", typer.colors.RED, id=vds_id, outcome='requested')
+        return
+    outcome, state = wait_vds(vds_id, 'off', timeout=timeout)
+    if outcome != 'ready':
+        wait_error(outcome, vds_status(state), id=vds_id)
+    done("Stopped", typer.colors.RED, id=vds_id, outcome=outcome, status='off')
 
 
 @servers_app.command("clone")
-def vds_clone(vds_id: Optional[int] = typer.Argument(None),
-              raw: bool = typer.Option(False, help="Get result as raw json")):
+def vds_clone(vds_id: Optional[str] = typer.Argument(None, help="VDS ID or selector", autocompletion=complete_vds),
+              raw: bool = typer.Option(False, help="Get result as raw json"),
+              wait: bool = typer.Option(True, help="Wait until clone is running"),
+              timeout: int = typer.Option(WAIT_TIMEOUT, help="Max seconds to wait"),
+              count: int = typer.Option(1, help="Number of clones"),
+              name: Optional[str] = typer.Option(None, help="Name of clones, {n} is number of clone "
+                                                            "and {source} is name of VDS, e.g. worker-{n:02}"),
+              concurrency: int = typer.Option(BULK_CONCURRENCY, help="Max clones requested at once")):
     """
-    Clone VDS
+    Clone VDS (many times)
     """
-    if vds_id is None:
-        if raw:
-            print(
-                dict(
-                    error="No VDS ID provided"
-                )
+    if vds_id is None and raw:
+        print(json.dumps(
+            dict(
+                error="No VDS ID provided"
             )
-            sys.exit(1)
-        vds_list()
-        vds_id = input("Enter VDS ID: ")
+        ))
+        sys.exit(1)
+    vds_id = get_id(vds_id)
+    if count > 1 or name is not None:
+        clone_many(vds_id, count, name, concurrency, raw, wait, timeout)
+        return
     new_vds = Server.clone(vds_id)
     if new_vds is None:
-        print(typer.style("Error", fg=typer.colors.RED))
-        sys.exit(1)
+        error(source_id=vds_id)
     else:
         if raw:
-            print(new_vds)
+            print(json.dumps(new_vds))
             return
         new_vds = new_vds['server']
+    caption = new_vds['configuration']['caption']
 
-    for frame in cycle(r'-\|/'):
-        state = Server.get_vds(new_vds['id'])
-        if state:
-            if state['server']['status'] == 'on':
-                print(typer.style("\nCloned: " + new_vds['configuration']['caption'], fg=typer.colors.GREEN))
-                break
-        print('\r', frame, sep='', end='', flush=True)
-        sleep(0.1)
+    if not wait:
+        done("Cloning: " + caption + ", id " + str(new_vds['id']),
+             id=new_vds['id'], name=caption, source_id=vds_id, outcome='requested')
+        return
+    outcome, state = wait_vds(new_vds['id'], 'on', timeout=timeout)
+    if outcome != 'ready':
+        wait_error(outcome, vds_status(state), id=new_vds['id'], name=caption, source_id=vds_id)
+    done("Cloned: " + caption, id=new_vds['id'], name=caption, source_id=vds_id, outcome=outcome, status='on')
+
+
+def clone_many(vds_id, count, name, concurrency, raw, wait, timeout):
+    """
+    Make count clones of VDS on a pool of workers and name them by template.
+    Only requests are limited by concurrency: all clones are waited for together by one poller,
+    so API load does not grow with count and they are ready in about the time of one.
+    """
+    source = ''
+    if name is not None and '{source' in name:
+        source = next((i['name'] for i in get_index('vds') if i['id'] == vds_id), None)
+        if source is None:
+            error("No such VDS: " + str(vds_id))
+    try:
+        name is None or name.format(n=1, source=source)
+    except (KeyError, IndexError, ValueError) as e:
+        error("Bad name template: " + str(e))
+
+    def worker(n):
+        result = Server.clone(vds_id)
+        if result is None:
+            return None, None, 'error', None
+        new = result['server']
+        caption = new['configuration']['caption']
+        if name is not None:
+            caption = name.format(n=n, source=source)
+            if Server.rename(new['id'], caption) is None:
+                return new['id'], caption, 'error', 'not renamed'
+        return new['id'], caption, 'requested', new.get('status')
+
+    def waiter(n, new_id, caption):
+        outcome, status = poller.wait(new_id, 'on', timeout)
+        return n, (new_id, caption, outcome, status)
+
+    x = Output(['n', 'id', 'name', 'outcome', 'status'], widths=dict(id=6, name=20, outcome=8, status=10))
+    rows = []
+
+    def report(n, result):
+        row = dict(zip(['id', 'name', 'outcome', 'status'], result), n=n, source_id=vds_id)
+        rows.append(row)
+        if not raw:
+            x.add(row)
+            x.flush()
+
+    # Waiting threads only sleep until poller wakes them, one per clone is fine
+    with ThreadPoolExecutor(max_workers=max(1, count)) as waiters:
+        waiting = []
+        for n, result in pool_map(worker, range(1, count + 1), concurrency):
+            if isinstance(result, Exception):
+                result = None, None, 'error', str(result)
+            if wait and result[2] == 'requested':
+                waiting.append(waiters.submit(waiter, n, result[0], result[1]))
+            else:
+                report(n, result)
+        for future in as_completed(waiting):
+            report(*future.result())
+    if raw:
+        print(json.dumps(rows))
+    else:
+        x.close()
+    if any(i['outcome'] not in ('ready', 'requested') for i in rows):
+        sys.exit(1)
 
 
 @servers_app.command("remove")
-def vds_remove(vds_id: Optional[int] = typer.Argument(None),
-               raw: bool = typer.Option(False, help="Get result as raw json")):
+def vds_remove(vds_ids: Optional[List[str]] = typer.Argument(None, help="VDS IDs or selectors",
+                                                             autocompletion=complete_vds),
+               raw: bool = typer.Option(False, help="Get result as raw json"),
+               wait: bool = typer.Option(True, help="Wait until VDS is deleted"),
+               timeout: int = typer.Option(WAIT_TIMEOUT, help="Max seconds to wait"),
+               stdin: bool = typer.Option(False, help="Read VDS IDs from stdin"),
+               concurrency: int = typer.Option(BULK_CONCURRENCY, help="Max VDSes processed at once")):
     """
-    Remove VDS
+    Remove VDS (or many of them)
     """
-    if vds_id is None:
-        if raw:
-            print(
-                dict(
-                    error="No VDS ID provided"
-                )
+    vds_ids = get_ids(vds_ids, stdin)
+    if not vds_ids and not raw:
+        vds_ids = ask_vds_id(multi=True)
+    if len(vds_ids) > 1:
+        bulk_report(bulk_action(vds_ids, Server.remove, None, concurrency, wait, timeout), raw)
+        return
+    if not vds_ids:
+        print(json.dumps(
+            dict(
+                error="No VDS ID provided"
             )
-            sys.exit(1)
-        vds_list()
-        vds_id = input("Enter VDS ID: ")
+        ))
+        sys.exit(1)
+    vds_id = vds_ids[0]
     result = Server.remove(vds_id)
     if result is None:
-        print(typer.style("Error", fg=typer.colors.RED))
-        sys.exit(1)
+        error(id=vds_id)
     else:
         if raw:
-            print(result)
+            print(json.dumps(result))
             sys.exit(0)
-    for frame in cycle(r'-\|/'):
-        state = Server.get_vds(vds_id)
-        if not state.get('server'):
-            print(typer.style("\nDeleted", fg=typer.colors.RED))
-            break
-        print('\r', frame, sep='', end='', flush=True)
-        sleep(0.1)
+    if not wait:
+        done("Deleting", typer.colors.RED, id=vds_id, outcome='requested')
+        return
+    outcome, state = wait_vds(vds_id, None, timeout=timeout)
+    if outcome != 'ready':
+        wait_error(outcome, vds_status(state), id=vds_id)
+    done("Deleted", typer.colors.RED, id=vds_id, outcome=outcome, status=None)
+
+
+def vds_record(i):
+    """
+    VDS from API as flat record for output
+    """
+    return dict(
+        id=i['id'],
+        status=i['status'],
+        name=i['name'],
+        ip=i['ip'],
+        cpus=i['configuration']['cpu'],
+        ram=i['configuration']['ram'],
+        disk=i['configuration']['disk_size']
+    )
+
+
+def vds_pretty(i):
+    """
+    Table row of vds_record
+    """
+    if i['status'] == 'on':
+        state = typer.style("Running", fg=typer.colors.GREEN)
+    elif i['status'] == 'off':
+        state = typer.style('Stopped', fg=typer.colors.RED)
+    else:
+        state = i['status']
+    return [i['id'], state, i['name'], i['ip'], i['cpus'], i['ram'], i['disk']] + \
+        ([i['change']] if 'change' in i else [])
+
+
+VDS_FIELDS = ['id', 'status', 'name', 'ip', 'cpus', 'ram', 'disk']
+VDS_WIDTHS = dict(id=6, name=20, ip=15)
+VDS_HEADERS = ['id', 'state', 'name', 'ip', 'cpus', 'ram', 'disk']
+
+
+def show_vds_list():
+    """
+    Print list of VDSes page by page
+    """
+    x = Output(VDS_FIELDS, headers=VDS_HEADERS, pretty=vds_pretty, widths=VDS_WIDTHS)
+    records = []
+    for page in Server.iter_pages():
+        if page is None:
+            error()
+        for i in page:
+            x.add(vds_record(i))
+            records.append(vds_index_record(i))
+        x.flush()
+    x.close()
+    index_save('vds', records)
+
+
+def watch_vds_list(interval, max_interval):
+    """
+    Print VDSes which were added, removed or changed status, ip or configuration since previous poll.
+    If nothing changes, poll interval doubles up to max_interval.
+    """
+    previous = dict()
+    delay = interval
+    while True:
+        current = dict()
+        with api.fresh():
+            pages = list(Server.iter_pages())
+        for page in pages:
+            if page is None:
+                # Failed poll is not "everything was removed", try again later
+                current = None
+                break
+            for i in page:
+                current[i['id']] = i
+        if current is None:
+            sleep(delay)
+            continue
+        index_save('vds', [vds_index_record(i) for i in current.values()])
+        changes = []
+        for vds_id, i in current.items():
+            old = previous.get(vds_id)
+            if old is None:
+                changes.append(dict(vds_record(i), change='added'))
+            elif any(old[key] != i[key] for key in WATCH_KEYS):
+                changes.append(dict(vds_record(i), change='changed'))
+        for vds_id in previous.keys() - current.keys():
+            changes.append(dict(vds_record(previous[vds_id]), change='removed'))
+
+        if changes:
+            if settings['output'] == 'table':
+                print(strftime('%H:%M:%S'))
+            x = Output(VDS_FIELDS + ['change'], headers=VDS_HEADERS + ['change'], pretty=vds_pretty)
+            for i in changes:
+                x.add(i)
+            x.close()
+            delay = interval
+        else:
+            delay = min(delay * 2, max_interval)
+        previous = current
+        sleep(delay)
 
 
 @servers_app.command("list")
-def vds_list():
+def vds_list(watch: bool = typer.Option(False, help="Keep polling and show only changed VDSes"),
+             interval: float = typer.Option(2, help="Poll interval for --watch, seconds"),
+             max_interval: float = typer.Option(60, help="Max poll interval when nothing changes")):
     """
     Show list of VDSes
     ID, State, Name, IP, CPUs, Ram, Disk
     """
-    list_of_servers = Server.get_list()
-    x = PrettyTable()
-    x.field_names = ['id', 'state', 'name', 'ip', 'cpus', 'ram', 'disk']
-    if list_of_servers is None:
-        print(typer.style("Error", fg=typer.colors.RED))
-        sys.exit(1)
-    for i in list_of_servers['servers']:
-        if i['status'] == 'on':
-            state = typer.style("Running", fg=typer.colors.GREEN)
-        elif i['status'] == 'off':
-            state = typer.style('Stopped', fg=typer.colors.RED)
+    if not watch:
+        show_vds_list()
+        return
+    try:
+        watch_vds_list(interval, max_interval)
+    except KeyboardInterrupt:
+        pass
+
+
+def load_manifest(path):
+    """
+    Manifest of VDSes and DBs, JSON or YAML (if PyYAML is installed):
+
+        {"servers": [{"name": "web-1", "os_id": 79, "preset": 18, "comment": "front"},
+                     {"name": "web-2", "clone_of": "web-1"}],
+         "dbs": [{"name": "main", "db_type": "postgres", "passwd": "..."}]}
+    """
+    if path.endswith(('.yml', '.yaml')):
+        try:
+            import yaml
+        except ImportError:
+            error("YAML manifest needs PyYAML (pip install pyyaml), JSON works without it")
+        load = yaml.safe_load
+    else:
+        load = json.load
+    try:
+        with open(path) as manifest_file:
+            manifest = load(manifest_file)
+    except Exception as e:
+        error("Bad manifest: " + str(e))
+    if not isinstance(manifest, dict):
+        error("Bad manifest: it should be a mapping with servers and dbs")
+    for kind, required in (('servers', ('name',)), ('dbs', ('name', 'db_type'))):
+        names = set()
+        for i in manifest.get(kind) or []:
+            if not isinstance(i, dict) or any(key not in i for key in required):
+                error("Bad manifest: every item of " + kind + " needs " + ', '.join(required))
+            if kind == 'servers' and 'os_id' not in i and 'clone_of' not in i:
+                error("Bad manifest: server " + i['name'] + " needs os_id or clone_of")
+            if i['name'] in names:
+                error("Bad manifest: " + i['name'] + " is there twice")
+            names.add(i['name'])
+    return manifest
+
+
+def make_plan(manifest, prune=False):
+    """
+    Steps to make VDSes and DBs match manifest (by name), from two list calls whatever the size:
+    create, clone (after its source is created), remove (with prune, after clones of it) and
+    drift (preset differs, nothing is done). Step is a dict, 'after' are keys of steps it depends on.
+    """
+    live = dict()
+    for i in get_index('vds', refresh=True):
+        live.setdefault(i['name'], []).append(i)
+    live_dbs = set(i['name'] for i in get_index('dbs', refresh=True))
+    wanted = dict((i['name'], i) for i in manifest.get('servers') or [])
+
+    steps = dict()
+    for name, spec in wanted.items():
+        if name in live:
+            vds = live[name][0]
+            if spec.get('preset') is not None and vds.get('preset_id') not in (None, spec['preset']):
+                steps['vds:' + name] = dict(action='drift', kind='vds', name=name, id=vds['id'], after=[],
+                                            detail="preset {} in manifest, {} live".format(spec['preset'],
+                                                                                           vds['preset_id']))
+            continue
+        source = spec.get('clone_of')
+        if source is None:
+            steps['vds:' + name] = dict(action='create', kind='vds', name=name, id=None, after=[], spec=spec,
+                                        detail="preset {}, os {}".format(spec.get('preset', 17), spec['os_id']))
+        elif source in live:
+            steps['vds:' + name] = dict(action='clone', kind='vds', name=name, id=None, after=[], spec=spec,
+                                        detail="of " + source, source=live[source][0]['id'])
+        elif source in wanted:
+            steps['vds:' + name] = dict(action='clone', kind='vds', name=name, id=None, after=['vds:' + source],
+                                        spec=spec, detail="of " + source, source=None)
         else:
-            state = i['status']
-        x.add_row([
-            i['id'],
-            state,
-            i['name'],
-            i['ip'],
-            i['configuration']['cpu'],
-            i['configuration']['ram'],
-            i['configuration']['disk_size']
-        ])
-    print(x)
+            error("No VDS " + source + " to clone " + name + " of")
+    if prune:
+        for name, servers in live.items():
+            if name in wanted:
+                continue
+            for vds in servers:
+                after = [key for key, step in steps.items()
+                         if step['action'] == 'clone' and step['spec']['clone_of'] == name]
+                steps['rm:' + str(vds['id'])] = dict(action='remove', kind='vds', name=name, id=vds['id'],
+                                                     after=after, detail=vds['status'])
+    for spec in manifest.get('dbs') or []:
+        if spec['name'] not in live_dbs:
+            steps['db:' + spec['name']] = dict(action='create', kind='db', name=spec['name'], id=None, after=[],
+                                               spec=spec, detail=spec['db_type'])
+    return steps
+
+
+def plan_pretty(record):
+    colors = dict(create=typer.colors.GREEN, clone=typer.colors.GREEN, remove=typer.colors.RED,
+                  drift=typer.colors.YELLOW)
+    return [typer.style(record['action'], fg=colors.get(record['action'])), record['kind'], record['name'],
+            record['id'] if record['id'] is not None else '', record['detail'], ', '.join(record['after'])]
+
+
+def show_plan(steps):
+    x = Output(['action', 'kind', 'name', 'id', 'detail', 'after'], pretty=plan_pretty)
+    for key, step in steps.items():
+        x.add(dict((field, step[field]) for field in x.fields))
+    x.close()
+
+
+@app.command("plan")
+def plan(manifest: str = typer.Argument(..., help="JSON (or YAML) file with servers and dbs"),
+         prune: bool = typer.Option(False, help="Remove VDSes which are not in manifest")):
+    """
+    Show what apply would do to make VDSes and DBs match manifest
+    """
+    show_plan(make_plan(load_manifest(manifest), prune))
+
+
+def step_task(step, created, group_id, timeout):
+    """
+    Functions doing plan step (request) and waiting until it is done (complete), for run_dag()
+    """
+    spec = step.get('spec') or {}
+    complete = lambda vds_id: poller.wait(vds_id, 'on', timeout)
+    if step['kind'] == 'db':
+        def request():
+            import secrets
+            result = Dbaas.create(spec.get('passwd') or secrets.token_urlsafe(16), spec['name'], spec['db_type'])
+            if result is None:
+                return 'error', None
+            created[step['name']] = result['db']['id']
+            return 'requested', result['db']['id']
+        complete = lambda db_id: db_poller.wait(db_id, 'started', timeout)
+    elif step['action'] == 'create':
+        def request():
+            result = Server.create(spec['name'], spec['os_id'], spec.get('preset', 17), spec.get('comment', ""),
+                                   group_id)
+            if result is None:
+                return 'error', None
+            created[step['name']] = result['server']['id']
+            return 'requested', result['server']['id']
+    elif step['action'] == 'clone':
+        def request():
+            source = step['source'] or created[spec['clone_of']]
+            result = Server.clone(source)
+            if result is None:
+                return 'error', None
+            created[step['name']] = result['server']['id']
+            if Server.rename(result['server']['id'], spec['name']) is None:
+                return 'error', 'not renamed'
+            return 'requested', result['server']['id']
+    elif step['action'] == 'remove':
+        def request():
+            if Server.remove(step['id']) is None:
+                return 'error', None
+            return 'requested', step['id']
+        complete = lambda vds_id: poller.wait(vds_id, None, timeout)
+    else:
+        def request():
+            return 'ready', None
+        complete = None
+    return request, complete
+
+
+@app.command("apply")
+def apply(manifest: str = typer.Argument(..., help="JSON (or YAML) file with servers and dbs"),
+          prune: bool = typer.Option(False, help="Remove VDSes which are not in manifest"),
+          yes: bool = typer.Option(False, help="Do not ask for confirmation"),
+          concurrency: int = typer.Option(POOL_SIZE, help="Max requests at once, steps are waited for all together"),
+          timeout: int = typer.Option(WAIT_TIMEOUT, help="Max seconds to wait for every step")):
+    """
+    Create, clone and remove VDSes and DBs to match manifest.
+    Independent steps run in parallel, so it takes about as long as the slowest of them.
+    """
+    steps = make_plan(load_manifest(manifest), prune)
+    steps = dict((key, step) for key, step in steps.items() if step['action'] != 'drift')
+    if not steps:
+        done("Nothing to do")
+        return
+    if not yes:
+        if not settings['interactive']:
+            error("Use --yes to apply without confirmation")
+        show_plan(steps)
+        if not typer.confirm("Apply?"):
+            error("Cancelled")
+
+    created = dict()
+    group_id = get_account().get('group_id') if any(i['action'] == 'create' for i in steps.values()) else None
+    tasks = dict((key, (step['after'],) + step_task(step, created, group_id, timeout)) for key, step in steps.items())
+    x = Output(['action', 'kind', 'name', 'id', 'outcome', 'status'],
+               widths=dict(name=20, id=6, outcome=8, status=10))
+    failed = False
+    for key, outcome, status in run_dag(tasks, concurrency):
+        step = steps[key]
+        failed = failed or outcome != 'ready'
+        x.add(dict(action=step['action'], kind=step['kind'], name=step['name'],
+                   id=step['id'] or created.get(step['name']), outcome=outcome, status=status))
+        x.flush()
+    x.close()
+    if failed:
+        sys.exit(1)
+
+
+def run_line(line, output, parallel=False):
+    """
+    Run one CLI line (without program name) in this process, sharing session and token.
+    output is format given to batch/shell. Line may override it and other global options (--deadline etc.)
+    for itself, but not when lines run in parallel: they are global. Returns exit code.
+    """
+    import click
+    import shlex
+    try:
+        args = shlex.split(line, comments=True)
+    except ValueError as e:
+        print("Parse error: " + str(e), file=sys.stderr)
+        return 2
+    if not args:
+        return 0
+    if args[0] in ('batch', 'shell'):
+        print("Nested " + args[0] + " is not supported", file=sys.stderr)
+        return 2
+    command = typer.main.get_command(app)
+    if parallel:
+        # Global options are before the first command name
+        for arg in args:
+            if arg in command.commands:
+                break
+            if arg.startswith('-'):
+                print("Global options of a line are not supported with --parallel: " + arg, file=sys.stderr)
+                return 2
+    deadline, rate = api.deadline, api.limiter.rate
+    try:
+        result = command.main(args=['--output', output] + args, prog_name='twvdscli', standalone_mode=False)
+    except SystemExit as e:
+        return e.code if isinstance(e.code, int) else (0 if e.code is None else 1)
+    except click.ClickException as e:
+        e.show()
+        return e.exit_code
+    except click.Abort:
+        return 1
+    except Exception as e:
+        # One broken line should not stop the whole batch
+        print("Error: " + repr(e), file=sys.stderr)
+        return 1
+    finally:
+        settings['output'] = output
+        api.deadline, api.limiter.rate = deadline, rate
+    return result if isinstance(result, int) else 0
+
+
+@app.command("batch")
+def batch(file: typer.FileText = typer.Argument("-", help="File with CLI lines, - is stdin"),
+          parallel: int = typer.Option(1, help="Run up to N lines at once, lines must be independent"),
+          stop: bool = typer.Option(False, help="Stop on first failed line")):
+    """
+    Run CLI lines from file in one process with one HTTP session and token:
+    vds start 1 2 3
+    snap create 1
+    Empty lines and # comments are skipped.
+    """
+    lines = [(n, line.strip()) for n, line in enumerate(file, 1)]
+    lines = [(n, line) for n, line in lines if line and not line.startswith('#')]
+    settings['interactive'] = False
+    output = settings['output']
+    failed = 0
+
+    def report(n, line, code):
+        if code:
+            print(typer.style("line {n}: exit code {code}: {line}".format(n=n, code=code, line=line),
+                              fg=typer.colors.RED), file=sys.stderr)
+
+    if parallel > 1:
+        with ThreadPoolExecutor(max_workers=parallel) as pool:
+            futures = dict((pool.submit(run_line, line, output, True), (n, line)) for n, line in lines)
+            for future in as_completed(futures):
+                n, line = futures[future]
+                code = future.result()
+                report(n, line, code)
+                failed += bool(code)
+                if code and stop:
+                    # Lines which are running already are finished, others are not started
+                    for other in futures:
+                        other.cancel()
+                    break
+    else:
+        for n, line in lines:
+            code = run_line(line, output)
+            report(n, line, code)
+            failed += bool(code)
+            if code and stop:
+                break
+    if failed:
+        sys.exit(1)
+
+
+@app.command("shell")
+def shell():
+    """
+    Interactive shell: run CLI commands one by one in one process, with one HTTP session and token.
+    exit or Ctrl-D to quit.
+    """
+    try:
+        import readline  # noqa: F401 (line editing and history for input())
+    except ImportError:
+        pass
+    output = settings['output']
+    while True:
+        try:
+            line = input("twvdscli> ")
+        except (EOFError, KeyboardInterrupt):
+            print()
+            break
+        if line.strip() in ('exit', 'quit'):
+            break
+        # Lines are minutes apart, what was read for previous one may be old
+        api.forget()
+        code = run_line(line, output)
+        if code:
+            print(typer.style("exit code " + str(code), fg=typer.colors.RED))
+
+
+def cache_path(name):
+    """
+    Path of a file in ~/.cache/twvdscli
+    """
+    return os.path.join(os.getenv('HOME'), '.cache', 'twvdscli', name)
+
+
+def cache_load(name):
+    """
+    Load json cache file, None if there is no (valid) one
+    """
+    try:
+        with open(cache_path(name)) as cachefile:
+            return json.load(cachefile)
+    except (OSError, ValueError):
+        return None
+
+
+def cache_save(name, data):
+    """
+    Save json cache file. Only owner can read it: tokens are stored there.
+    """
+    path = cache_path(name)
+    os.makedirs(os.path.dirname(path), mode=0o700, exist_ok=True)
+    # Unique temporary name: workers of one process may save the same file at once
+    tmp = '{}.{}.{}.tmp'.format(path, os.getpid(), threading.get_ident())
+    with open(os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), 'w') as cachefile:
+        json.dump(data, cachefile)
+    os.replace(tmp, path)
+
+
+def cache_drop(name):
+    try:
+        os.remove(cache_path(name))
+    except OSError:
+        pass
+
+
+def key_digest(based):
+    """
+    Cache entries are bound to credentials (and API they are for),
+    but we don't want to store credentials twice
+    """
+    import hashlib
+    return hashlib.sha256((api.base_url + ' ' + based).encode('utf-8')).hexdigest()
+
+
+def get_catalog(name, refresh=False):
+    """
+    Catalog of presets or os'es. They are almost never changed,
+    so they are cached for catalog_ttl seconds (see [cache] section of config).
+    Stale cache is revalidated with ETag/Last-Modified if API gave them,
+    refresh means download it anyway.
+    If API is not available, stale cache is better than nothing.
+    """
+    cached = cache_load(name + '.json')
+    ttl = load_config().getint('cache', 'catalog_ttl', fallback=CATALOG_TTL)
+    if cached and not refresh and cached['fetched_at'] + ttl > time():
+        return cached['data']
+
+    headers = dict()
+    if cached and not refresh:
+        if cached.get('etag'):
+            headers['If-None-Match'] = cached['etag']
+        if cached.get('last_modified'):
+            headers['If-Modified-Since'] = cached['last_modified']
+    result = api.get(CATALOGS[name], headers=headers)
+    if result.status_code == 304 and cached:
+        cached['fetched_at'] = time()
+        cache_save(name + '.json', cached)
+        return cached['data']
+    if not result.ok:
+        return cached['data'] if cached else None
+    data = result.json()
+    cache_save(name + '.json', dict(
+        fetched_at=time(),
+        etag=result.headers.get('ETag'),
+        last_modified=result.headers.get('Last-Modified'),
+        data=data
+    ))
+    return data
+
+
+def catalog_ids(name):
+    """
+    Set of ids in catalog, None if it is not available
+    """
+    catalog = get_catalog(name)
+    if catalog is None:
+        return None
+    return set(i['id'] for i in catalog[name])
+
+
+def vds_index_record(i):
+    """
+    VDS from API list as record of local index
+    """
+    return dict(vds_record(i), disk_id=disk_of(i), preset_id=i.get('preset_id'))
+
+
+def db_index_record(i):
+    """
+    DB from API list as record of local index, password is not stored there
+    """
+    return dict((key, i.get(key)) for key in ('id', 'status', 'name', 'ip', 'local_ip', 'type'))
+
+
+# In-memory copy of index for this process
+indexes = dict()
+
+
+def index_save(kind, records):
+    data = dict(url=api.base_url, updated=time(), items=records)
+    indexes[kind] = data
+    cache_save('index-' + kind + '.json', data)
+
+
+def index_drop(kind):
+    """
+    Something was changed, index is not valid anymore
+    """
+    if indexes.pop(kind, None) is not None or os.path.exists(cache_path('index-' + kind + '.json')):
+        cache_drop('index-' + kind + '.json')
+
+
+def index_cached(kind):
+    """
+    Records of local index as they are, and if they are fresh. (None, False) if there is no index.
+    """
+    data = indexes.get(kind) or cache_load('index-' + kind + '.json')
+    if not data or data.get('url') != api.base_url:
+        return None, False
+    indexes[kind] = data
+    return data['items'], data['updated'] + load_config().getint('cache', 'index_ttl', fallback=INDEX_TTL) > time()
+
+
+def fetch_index(kind):
+    """
+    Fetch and save local index, None if API failed
+    """
+    iter_pages, record = (Server.iter_pages, vds_index_record) if kind == 'vds' else \
+        (Dbaas.iter_pages, db_index_record)
+    records = []
+    with api.fresh():
+        pages = list(iter_pages())
+    for page in pages:
+        if page is None:
+            return None
+        records.extend(record(i) for i in page)
+    index_save(kind, records)
+    return records
+
+
+def get_index(kind, refresh=False):
+    """
+    Records of local index of VDSes or DBs (kind is 'vds' or 'dbs'): id, name, ip, status, configuration.
+    Fetched from API only if index is missing, stale or refresh is asked.
+    """
+    if not refresh:
+        records, fresh = index_cached(kind)
+        if fresh:
+            return records
+    records = fetch_index(kind)
+    if records is None:
+        error()
+    return records
+
+
+def parse_selector(selector):
+    """
+    Check of index records by selector: name:web-*, ip:10.0.*, status=off,ram>=4096.
+    Conditions are joined by comma and all of them must hold.
+    field:pattern is shell pattern match, comparisons are numeric if both sides are numbers.
+    Bare word is pattern of name. Check raises ValueError for unknown field.
+    """
+    import fnmatch
+    import operator
+    import re
+    ops = {'=': operator.eq, '!=': operator.ne, '>=': operator.ge, '<=': operator.le,
+           '>': operator.gt, '<': operator.lt}
+
+    def number(value):
+        try:
+            return float(value)
+        except (TypeError, ValueError):
+            return None
+
+    checks = []
+    for part in selector.split(','):
+        match = re.match(r'^(\w+)(>=|<=|!=|=|>|<|:)(.*)$', part.strip())
+        checks.append(match.groups() if match else ('name', ':', part.strip()))
+
+    def check(record):
+        for key, op, value in checks:
+            if key not in record:
+                raise ValueError("Unknown field in selector: " + key)
+            have = record[key]
+            if op == ':':
+                if have is None or not fnmatch.fnmatchcase(str(have), value):
+                    return False
+            elif number(have) is not None and number(value) is not None:
+                if not ops[op](number(have), number(value)):
+                    return False
+            elif not ops[op](str(have), value):
+                return False
+        return True
+    return check
+
+
+def resolve(kind, arg):
+    """
+    IDs of VDSes or DBs for argument: number is ID as is, with no API call,
+    anything else is selector (see parse_selector) over local index.
+    If nothing matches, index may be just old, so it is fetched once more.
+    """
+    arg = str(arg).strip()
+    if arg.isdigit():
+        return [int(arg)]
+    check = parse_selector(arg)
+    try:
+        ids = [i['id'] for i in get_index(kind) if check(i)]
+        if not ids and indexes[kind]['updated'] < time() - 1:
+            ids = [i['id'] for i in get_index(kind, refresh=True) if check(i)]
+    except ValueError as e:
+        error(str(e))
+    if not ids:
+        error("Nothing matches: " + arg)
+    return ids
 
 
 def auth(based):
     """
     Get access token based on base64'ed login:password
+    Returns dict with access_token and expires_at
     """
     headers = {"Authorization": "Basic " + based}
 
-    result = requests.post(
-        'https://public-api.timeweb.com/api/v2/auth',
-        headers=headers
-    )
+    result = api.post('/api/v2/auth', headers=headers, reauth=False)
     if not result.ok:
         return None
     else:
         result = result.content.decode('utf-8')
         result = json.loads(result)
-        result = result['access_token']
-        return result
+        expires_in = result.get('expires_in') or TOKEN_TTL
+        return dict(
+            access_token=result['access_token'],
+            expires_at=time() + int(expires_in)
+        )
 
 
-def get_api_key():
+@functools.lru_cache(maxsize=None)
+def load_config():
     """
-    Load base64'ed login:pass and get access token
+    Config file, read once per run
     """
+    import configparser
     config = configparser.ConfigParser()
     config.read(os.path.join(os.getenv('HOME'), '.config', 'twvdscli.ini'))
+    return config
+
+
+def load_key():
+    """
+    Load base64'ed login:pass, ask for it if there is none
+    """
+    config = load_config()
     based = config.get('api', 'key', fallback=None)
     if based is None:
         login = input("Enter login ")
@@ -852,20 +3423,113 @@ def get_api_key():
 
         with open(os.path.join(os.getenv('HOME'), '.config', 'twvdscli.ini'), 'w') as configfile:
             config.write(configfile)
+        load_config.cache_clear()
+    return based
+
 
-    result = auth(based)
-    return result
+def get_api_key(refresh=False):
+    """
+    Load base64'ed login:pass and get access token.
+    Token is taken from cache while it is not expired, unless refresh is set.
+    """
+    based = load_key()
+    digest = key_digest(based)
 
+    token = cache_load('token.json')
+    if not refresh and token and token.get('key') == digest \
+            and token.get('expires_at', 0) - TOKEN_MARGIN > time():
+        return token['access_token']
 
-def main():
+    token = auth(based)
+    if token is None:
+        cache_drop('token.json')
+        return None
+    token['key'] = digest
+    cache_save('token.json', token)
+    return token['access_token']
+
+
+def get_account():
+    """
+    Username and group id of current account, cached between runs
+    """
+    based = load_key()
+    digest = key_digest(based)
+    account = cache_load('account.json')
+    if account and account.get('key') == digest:
+        return account
+
+    user = str(base64.b64decode(based), 'utf-8').split(':')[0]
+    account = dict(key=digest, user=user, group_id=None)
+    group_uri = "/api/v1/accounts/{user}/group"
+    result = api.get(group_uri, user=user)
+    if result.ok:
+        account['group_id'] = result.json()['groups'][0]['id']
+        cache_save('account.json', account)
+    return account
+
+
+def login():
+    """
+    Authorize client. It is done on first API request, but can be called explicitly
+    to fail early when using backend from python:
+
+        import twvdscli
+        twvdscli.login()
+        twvdscli.Server.get_list()
+    """
     apikey = get_api_key()
     if apikey is None:
         print(typer.style("Auth Error", fg=typer.colors.RED))
         sys.exit(1)
-    reqHeader['Authorization'] += apikey
-    app()
+    api.authorize(apikey)
+
+
+@app.callback()
+def callback(ctx: typer.Context,
+             output: OutputFormat = typer.Option("table", "--output", "-o",
+                                                 help="Output format, ndjson and csv are streamed"),
+             timings: bool = typer.Option(False, help="Print API calls summary to stderr"),
+             trace: Optional[str] = typer.Option(None, help="Write every API call to FILE as JSON lines"),
+             prometheus: Optional[str] = typer.Option(None, help="Write API metrics to Prometheus textfile"),
+             deadline: Optional[float] = typer.Option(None, help="Max seconds for the whole command"),
+             rate_limit: Optional[float] = typer.Option(None, help="Max API requests per second, 0 is no limit "
+                                                                  "[default: " + str(RATE_LIMIT) + "]")):
+    """
+    Manage servers and services in Timeweb Cloud
+    """
+    settings['output'] = output.value
+    if deadline is not None:
+        api.deadline = time() + deadline
+    if rate_limit is not None:
+        api.limiter.rate = rate_limit
+    # Lines of batch/shell get here too, they must not turn tracing of the whole run off
+    if trace:
+        tracer.trace_file = open(trace, 'a')
+    if timings or trace or prometheus:
+        tracer.enabled = True
+
+        def finish():
+            if timings:
+                tracer.summary()
+            if prometheus:
+                tracer.write_prometheus(prometheus)
+            if trace:
+                tracer.trace_file.close()
+                tracer.trace_file = None
+        ctx.call_on_close(finish)
+
+
+def main():
+    # No auth here: --help, completion and usage errors must not go to network
+    try:
+        app()
+    except DeadlineExceeded as e:
+        error(str(e))
+    except OSError as e:
+        # requests exceptions are OSError too, that is what we get after all retries
+        error("Error: " + (api.last_error or str(e)))
 
 
 if __name__ == '__main__':
-    reqHeader = {"Authorization": "Bearer "}
     main()